@@ -17,23 +17,30 @@ logger = get_logger('anomali-threatstream')
 #logger.setLevel(logging.DEBUG) # Uncomment to enable local debug
 
 class ThreatStream(Connector):
+    def __init__(self, *args, **kwargs):
+        super(ThreatStream, self).__init__(*args, **kwargs)
+        if getattr(self, '_info_json', None):
+            load_operation_registry(self._info_json)
+
     def execute(self, config, operation, params, **kwargs):
         logger.info('execute(): operation is {0}'.format(str(operation)))
         try:
             logger.info('execute [{0}]'.format(operation))
             operation_info = get_curr_oper_info(self._info_json, operation)
-            if operation_info['handler_method'] is False:
-                return api_request(config, params, operation_info)
-            else:
-                operation = operation_sym.get(operation)
-                return operation(config, params)
+            with operation_context(config, operation, params):
+                if operation_info['handler_method'] is False:
+                    return api_request(config, params, operation_info)
+                else:
+                    operation = operation_info['handler']
+                    return operation(config, params)
         except Exception as err:
             logger.exception(err)
             raise ConnectorError(err)
 
     def check_health(self, config):
         logger.info('Performing health check')
-        check_health(config)
+        with operation_context(config, 'check_health'):
+            check_health(config)
         logger.info('Completed health check with no error')
 
     def del_micro(self, config):
@@ -48,14 +55,32 @@ class ThreatStream(Connector):
                 except Exception as e:
                     logger.error(e)
 
+    def get_configs(self, config):
+        # Activation hooks receive all configurations of the connector, keyed by configuration ID
+        if isinstance(config, dict) and 'base_url' not in config:
+            return [value for value in config.values() if isinstance(value, dict)]
+        return [config] if config else []
+
     def on_deactivate(self, config):
         self.del_micro(config)
+        for item in self.get_configs(config):
+            stop_cache_warmer(item)
 
     def on_activate(self, config):
         self.del_micro(config)
+        for item in self.get_configs(config):
+            start_cache_warmer(item)
 
     def on_add_config(self, config, active):
         self.del_micro(config)
+        if active:
+            start_cache_warmer(config)
+
+    def on_update_config(self, old_config, new_config, active):
+        stop_cache_warmer(old_config)
+        if active:
+            start_cache_warmer(new_config)
 
     def on_delete_config(self, config):
         self.del_micro(config)
+        stop_cache_warmer(config)
@@ -4,16 +4,35 @@ MIT License
 Copyright (c) 2024 Fortinet Inc Copyright end
 """
 
-from time import sleep
-import validators, json
+from time import sleep, monotonic, time
+import json
+import threading
+from math import ceil
+from contextlib import contextmanager, nullcontext
 import os
+import csv
+import gzip
+import hashlib
+import re
+from itertools import chain
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from ipaddress import ip_address, ip_network
 from os.path import join, exists
-from requests import request, exceptions as req_exceptions
+from requests import Session, exceptions as req_exceptions
+from requests.adapters import HTTPAdapter
 from datetime import datetime, timedelta
 from connectors.core.connector import Connector, get_logger, ConnectorError
 from integrations.crudhub import make_request
 from django.conf import settings
 
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
 logger = get_logger("anomali-threatstream")
 
 FILE_REF = "Attachment ID"
@@ -21,6 +40,19 @@ IMPORT_OBSERVABLES = "/api/v2/intelligence/import/"
 MAX_RETRY = 5
 DELAY_TIME = 10
 MAX_REQUEST_TIMEOUT = 600
+CONNECT_TIMEOUT = 10
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_COOLDOWN = 60
+CIRCUIT_BREAKER_PROBE_ENDPOINT = "/api/v2/intelligence/"
+MAX_CONCURRENT_REQUESTS = 10
+TARGET_PAGE_TIME = 10
+MIN_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 1000
+INITIAL_PAGE_SIZE = 500
+MAX_PAGE_BYTES = 20 * 1024 * 1024
+INTERACTIVE_PRIORITY = "interactive"
+BULK_PRIORITY = "bulk"
+BULK_OPERATIONS = ["submit_observables", "aggregate_intelligence", "warm_reputation_cache"]
 MACRO_LIST = [
     "IP_Enrichment_Playbooks_IRIs",
     "URL_Enrichment_Playbooks_IRIs",
@@ -89,6 +121,87 @@ itype_dict = {
     "file_reputation": "md5",
 }
 
+# When an action is listed in more than one category, the first category takes precedence
+ACTION_CATEGORIES = {
+    action: action_category
+    for action_category, actions in reversed((
+        ("query", query_actions),
+        ("whois", whois_action),
+        ("list", action_list),
+        ("tb", tb_action),
+        ("investigation", investigation_actions),
+        ("reputation", itype_dict),
+    ))
+    for action in actions
+}
+
+RAW_RESPONSE_ACTIONS = frozenset(resp_list) | frozenset(query_actions)
+
+PAGE_SIZES = {
+    "query": 0,
+    "tb": 1000,
+    "investigation": 1000,
+    "reputation": 0
+}
+
+INVESTIGATION_ELEMENT_BATCH_SIZE = 100
+
+REPUTATION_CACHE_MAX_SIZE = 100000
+CACHE_WARMING_INTERVAL = 60
+CACHE_WARMING_LOOKBACK = 24
+CACHE_WARMING_MIN_CONFIDENCE = 80
+CACHE_WARMING_MAX_RECORDS = 250
+CACHE_WARMING_REQUESTS_PER_SECOND = 2
+
+INDICATOR_REPUTATION_ACTIONS = {
+    "IP": "ip_reputation",
+    "Domain": "domain_reputation",
+    "URL": "url_reputation",
+    "Email": "email_reputation",
+    "MD5": "file_reputation",
+    "SHA-1": "file_reputation",
+    "SHA-256": "file_reputation",
+    "CIDR": "ip_reputation"
+}
+
+HASH_TYPES = {32: "MD5", 40: "SHA-1", 64: "SHA-256"}
+
+ENRICHMENT_SOURCES = ["Reputation", "Whois", "Passive DNS", "Recorded Future", "Risk IQ"]
+
+ENRICHMENT_SOURCE_TIMEOUT = 30
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+JOB_JOURNAL_DIR = "/tmp/threatstream-jobs"
+JOB_JOURNAL_RETENTION = 7
+
+MATERIALIZED_QUERY_DIR = "/tmp/threatstream-queries"
+MATERIALIZED_QUERY_RETENTION = 7
+MATERIALIZED_QUERY_MAX_AGE = 24
+
+THREAT_MODEL_ENTITY_TYPES = ["Actor", "Campaign", "Incident", "Signature", "Tipreport", "TTP", "Vulnerability"]
+
+OUTPUT_FILE_FORMATS = {
+    "Attachment (NDJSON)": "ndjson",
+    "Attachment (CSV)": "csv"
+}
+
+INTELLIGENCE_QUERY_ENDPOINTS = {
+    "Filter Language Query": "/api/v2/intelligence/?q={value}",
+    "Advanced Search": "/api/v2/intelligence/?{value}"
+}
+
+AGGREGATION_FIELDS = {
+    "Indicator Type": "itype",
+    "Severity": "meta.severity",
+    "Confidence": "confidence",
+    "Source": "source",
+    "Status": "status",
+    "Threat Type": "threat_type",
+    "Observable Type": "type",
+    "Country": "country"
+}
+
 PUBLISHED_STATUS_MAPPING = {
     "Pending Review": "pending_review",
     "Review Requested": "review_requested",
@@ -110,20 +223,518 @@ def check_server_url(url):
     return url
 
 
-def get_curr_oper_info(info_json, action):
+def get_config_int(config, key, default):
+    value = config.get(key)
+    if value is None or value == "":
+        return default
     try:
-        operations = info_json.get("operations")
-        exec_action = [
-            action_info
-            for action_info in operations
-            if action_info["operation"] == action
-        ]
-        return exec_action[0]
+        return int(value)
+    except (TypeError, ValueError):
+        raise ConnectorError("Invalid value for {0}: {1}".format(key, value))
+
+
+class CircuitBreaker(object):
+    """Fails requests fast after consecutive failures until a probe request succeeds again"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failure_count = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_request(self, probe):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            remaining = self.cooldown - (monotonic() - self.opened_at)
+            if remaining > 0 or self.probing:
+                raise ConnectorError(
+                    "ThreatStream is unavailable after {0} consecutive failures, failing fast for the "
+                    "next {1} seconds".format(self.failure_count, max(ceil(remaining), 0))
+                )
+            self.probing = True
+
+        logger.info("Circuit breaker half-open, probing ThreatStream")
+        try:
+            probe()
+        except Exception as err:
+            with self.lock:
+                self.opened_at = monotonic()
+                self.probing = False
+            logger.error("Circuit breaker probe failed: {0}".format(str(err)))
+            raise ConnectorError("ThreatStream is still unavailable: {0}".format(str(err)))
+        self.record_success()
+
+    def record_success(self):
+        with self.lock:
+            if self.opened_at is not None:
+                logger.info("Circuit breaker closed, ThreatStream has recovered")
+            self.failure_count = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failure_count += 1
+            if self.opened_at is None and self.failure_count >= self.threshold:
+                logger.error("Circuit breaker opened after {0} consecutive failures".format(self.failure_count))
+                self.opened_at = monotonic()
+
+
+class RequestScheduler(object):
+    """Shares a concurrency and rate budget between priority classes, letting interactive requests go first"""
+
+    def __init__(self, max_concurrent, rate_limit):
+        self.max_concurrent = max_concurrent
+        self.rate_limit = rate_limit
+        self.active = 0
+        self.waiting = {INTERACTIVE_PRIORITY: 0, BULK_PRIORITY: 0}
+        self.wait_stats = {
+            priority: {"requests": 0, "total_wait": 0.0, "max_wait": 0.0}
+            for priority in (INTERACTIVE_PRIORITY, BULK_PRIORITY)
+        }
+        self.next_request_at = 0
+        self.condition = threading.Condition()
+
+    def can_start(self, priority):
+        if self.active >= self.max_concurrent:
+            return False
+        if priority == BULK_PRIORITY:
+            # Bulk requests wait for queued interactive requests and leave a slot free for them
+            return self.waiting[INTERACTIVE_PRIORITY] == 0 and (
+                self.max_concurrent == 1 or self.active < self.max_concurrent - 1)
+        return True
 
-    except Exception as err:
-        logger.error("{0}".format(str(err)))
+    @contextmanager
+    def slot(self, priority):
+        queued_at = monotonic()
+        with self.condition:
+            self.waiting[priority] += 1
+            try:
+                while not self.can_start(priority):
+                    remaining = get_remaining_time()
+                    self.condition.wait(remaining)
+                self.active += 1
+            finally:
+                self.waiting[priority] -= 1
+                self.condition.notify_all()
+            start_at = queued_at
+            if self.rate_limit > 0:
+                start_at = max(monotonic(), self.next_request_at)
+                self.next_request_at = start_at + 1.0 / self.rate_limit
+        try:
+            delay = start_at - monotonic()
+            if delay > 0:
+                wait_before_retry(delay)
+            self.record_wait(priority, monotonic() - queued_at)
+            yield
+        finally:
+            with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def record_wait(self, priority, wait_time):
+        with self.condition:
+            stats = self.wait_stats[priority]
+            stats["requests"] += 1
+            stats["total_wait"] += wait_time
+            stats["max_wait"] = max(stats["max_wait"], wait_time)
+        if wait_time >= 1:
+            logger.info("{0} request waited {1:.2f} seconds in the request queue".format(priority, wait_time))
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                priority: dict(
+                    stats,
+                    average_wait=stats["total_wait"] / stats["requests"] if stats["requests"] else 0.0,
+                    waiting=self.waiting[priority]
+                )
+                for priority, stats in self.wait_stats.items()
+            }
 
-        raise ConnectorError("{0}".format(str(err)))
+
+circuit_breakers = dict()
+circuit_breakers_lock = threading.Lock()
+request_schedulers = dict()
+request_schedulers_lock = threading.Lock()
+operation_state = threading.local()
+
+
+def get_config_key(config):
+    return check_server_url(config.get("base_url", "")), config.get("api_username")
+
+
+def get_request_scheduler(config):
+    max_concurrent = get_config_int(config, "max_concurrent_requests", MAX_CONCURRENT_REQUESTS)
+    rate_limit = get_config_int(config, "max_requests_per_second", 0)
+    if max_concurrent <= 0 and rate_limit <= 0:
+        return None
+    with request_schedulers_lock:
+        scheduler = request_schedulers.get(get_config_key(config))
+        if scheduler is None:
+            scheduler = request_schedulers[get_config_key(config)] = RequestScheduler(max_concurrent, rate_limit)
+    with scheduler.condition:
+        scheduler.max_concurrent = max_concurrent if max_concurrent > 0 else float("inf")
+        scheduler.rate_limit = rate_limit
+        scheduler.condition.notify_all()
+    return scheduler
+
+
+def get_scheduler_stats(config):
+    scheduler = get_request_scheduler(config)
+    return scheduler.get_stats() if scheduler else dict()
+
+
+def get_request_priority(operation, params):
+    """Return the priority class of an operation; the request_priority parameter is removed so that it is not
+    sent to ThreatStream"""
+    priority = str((params or {}).pop("request_priority", None) or "").strip().lower()
+    if priority:
+        if priority not in (INTERACTIVE_PRIORITY, BULK_PRIORITY):
+            raise ConnectorError("Invalid request priority: {0}".format(priority))
+        return priority
+    if operation in BULK_OPERATIONS or (params or {}).get("record_number") == "Fetch All Records":
+        return BULK_PRIORITY
+    return INTERACTIVE_PRIORITY
+
+
+def get_circuit_breaker(config):
+    threshold = get_config_int(config, "circuit_breaker_threshold", CIRCUIT_BREAKER_THRESHOLD)
+    if threshold <= 0:
+        return None
+    key = get_config_key(config)
+    with circuit_breakers_lock:
+        breaker = circuit_breakers.get(key)
+        if breaker is None:
+            breaker = circuit_breakers[key] = CircuitBreaker(threshold, CIRCUIT_BREAKER_COOLDOWN)
+        breaker.threshold = threshold
+        breaker.cooldown = get_config_int(config, "circuit_breaker_cooldown", CIRCUIT_BREAKER_COOLDOWN)
+    return breaker
+
+
+@contextmanager
+def operation_context(config, operation=None, params=None):
+    """Apply the overall deadline and request priority to every request, retry and page of an operation"""
+    previous_deadline = getattr(operation_state, "deadline", None)
+    previous_priority = getattr(operation_state, "priority", None)
+    operation_timeout = get_config_int(config, "operation_timeout", 0)
+    deadline = monotonic() + operation_timeout if operation_timeout > 0 else None
+    if previous_deadline is not None and (deadline is None or previous_deadline < deadline):
+        deadline = previous_deadline
+    operation_state.deadline = deadline
+    if operation or previous_priority is None:
+        operation_state.priority = get_request_priority(operation, params)
+    try:
+        yield
+    finally:
+        operation_state.deadline = previous_deadline
+        operation_state.priority = previous_priority
+
+
+def get_remaining_time():
+    deadline = getattr(operation_state, "deadline", None)
+    if deadline is None:
+        return None
+    remaining = deadline - monotonic()
+    if remaining <= 0:
+        raise ConnectorError("The operation did not complete within the configured operation timeout")
+    return remaining
+
+
+def wait_before_retry(delay):
+    remaining = get_remaining_time()
+    if remaining is not None and remaining <= delay:
+        raise ConnectorError("The operation did not complete within the configured operation timeout")
+    sleep(delay)
+
+
+def run_concurrently(func, items, max_workers):
+    """Call func for each item in a thread pool, sharing the deadline and priority of the calling operation.
+    Returns a (result, error) tuple per item, in the order of the items"""
+    deadline = getattr(operation_state, "deadline", None)
+    priority = getattr(operation_state, "priority", None)
+
+    def run(item):
+        operation_state.deadline = deadline
+        operation_state.priority = priority
+        try:
+            return func(item), None
+        except Exception as err:
+            logger.error("{0}".format(str(err)))
+            return None, str(err)
+        finally:
+            operation_state.deadline = None
+            operation_state.priority = None
+
+    items = list(items)
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=max(min(max_workers, len(items)), 1)) as executor:
+        return list(executor.map(run, items))
+
+
+def get_max_workers(config):
+    max_workers = get_config_int(config, "max_concurrent_requests", MAX_CONCURRENT_REQUESTS)
+    return max_workers if max_workers > 0 else MAX_CONCURRENT_REQUESTS
+
+
+def get_request_timeout(config):
+    connect_timeout = get_config_int(config, "connect_timeout", CONNECT_TIMEOUT)
+    read_timeout = get_config_int(config, "read_timeout", MAX_REQUEST_TIMEOUT)
+    remaining = get_remaining_time()
+    if remaining is not None:
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+    return connect_timeout, read_timeout
+
+
+class Http2Response(object):
+    """Exposes an httpx response through the requests.Response attributes used by the connector"""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.reason = response.reason_phrase
+        self.headers = response.headers
+        self.url = str(response.url)
+
+    @property
+    def content(self):
+        return self.response.content
+
+    @property
+    def text(self):
+        return self.response.text
+
+    @property
+    def ok(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.response.json()
+
+
+class Http2Transport(object):
+    """Sends requests over a single multiplexed HTTP/2 connection, with the requests call signature"""
+
+    def __init__(self, httpx, verify, max_connections):
+        self.httpx = httpx
+        # httpcore assigns a stream ID before taking the lock that writes the request headers, so concurrent
+        # threads can send headers out of stream ID order, which the server rejects as a protocol error
+        self.open_stream_lock = threading.Lock()
+        self.client = httpx.Client(
+            http2=True,
+            verify=verify,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    @staticmethod
+    def prepare_files(files):
+        # Encode multipart fields the way requests does: skip empty fields and send other values as text
+        prepared = dict()
+        for name, value in files.items():
+            if isinstance(value, tuple):
+                if value[1] is None:
+                    continue
+                if isinstance(value[1], (bool, int, float)):
+                    value = (value[0], str(value[1])) + value[2:]
+            prepared[name] = value
+        return prepared
+
+    @staticmethod
+    def prepare_data(data):
+        prepared = dict()
+        for name, value in data.items():
+            if isinstance(value, tuple):
+                value = [item for item in value if item is not None]
+                value = value[0] if len(value) == 1 else value
+            prepared[name] = str(value) if isinstance(value, bool) else value
+        return prepared
+
+    def request(self, method, url, params=None, data=None, json=None, files=None, headers=None, timeout=None,
+                verify=None):
+        httpx = self.httpx
+        if params:
+            # httpx replaces the query string of the URL with params, while requests appends to it
+            url = str(httpx.URL(url).copy_merge_params(params))
+        kwargs = dict(json=json, headers=headers)
+        if files:
+            kwargs["files"] = self.prepare_files(files)
+        if isinstance(data, (str, bytes)):
+            kwargs["content"] = data
+        elif data:
+            kwargs["data"] = self.prepare_data(data)
+        if isinstance(timeout, tuple):
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        lock_held = [True]
+
+        def release_open_stream_lock():
+            if lock_held[0]:
+                lock_held[0] = False
+                self.open_stream_lock.release()
+
+        def trace(event, info):
+            # Streams are opened one at a time; the requests are still multiplexed once their headers are sent
+            if event.endswith(("send_request_headers.complete", "send_request_headers.failed")):
+                release_open_stream_lock()
+
+        self.open_stream_lock.acquire()
+        try:
+            return Http2Response(self.client.request(method, url, timeout=timeout, extensions={"trace": trace},
+                                                     **kwargs))
+        except httpx.ConnectTimeout as err:
+            raise req_exceptions.ConnectTimeout(str(err))
+        except httpx.TimeoutException as err:
+            raise req_exceptions.ReadTimeout(str(err))
+        except httpx.TransportError as err:
+            raise req_exceptions.ConnectionError(str(err))
+        finally:
+            release_open_stream_lock()
+
+
+http_clients = dict()
+http_clients_lock = threading.Lock()
+
+
+def create_http_client(config, max_connections):
+    if config.get("use_http2") is True:
+        try:
+            import httpx
+            import h2
+            return Http2Transport(httpx, config.get("verify_ssl"), max_connections)
+        except ImportError:
+            logger.warning("HTTP/2 requires the httpx and h2 packages, falling back to HTTP/1.1")
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_http_client(config):
+    """Return the connection pool shared by all operations of a configuration"""
+    max_connections = get_config_int(config, "max_concurrent_requests", MAX_CONCURRENT_REQUESTS)
+    if max_connections <= 0:
+        max_connections = MAX_CONCURRENT_REQUESTS
+    key = get_config_key(config) + (config.get("verify_ssl"), config.get("use_http2") is True, max_connections)
+    with http_clients_lock:
+        client = http_clients.get(key)
+        if client is None:
+            client = http_clients[key] = create_http_client(config, max_connections)
+    return client
+
+
+def probe_server(config):
+    response = get_http_client(config).request(
+        "GET",
+        check_server_url(config.get("base_url")) + CIRCUIT_BREAKER_PROBE_ENDPOINT,
+        params=dict(generate_payload(config, None), limit=1),
+        verify=config.get("verify_ssl"),
+        timeout=get_request_timeout(config)
+    )
+    if response.status_code >= 500:
+        raise ConnectorError("{0}: {1}".format(response.status_code, response.reason))
+
+
+def send_request(config, method, url, **kwargs):
+    """Common HTTP request handler applying timeouts, the operation deadline, request scheduling and the circuit
+    breaker"""
+    breaker = get_circuit_breaker(config)
+    if breaker:
+        breaker.before_request(lambda: probe_server(config))
+    scheduler = get_request_scheduler(config)
+    priority = getattr(operation_state, "priority", None) or INTERACTIVE_PRIORITY
+    kwargs.setdefault("verify", config.get("verify_ssl"))
+    try:
+        with scheduler.slot(priority) if scheduler else nullcontext():
+            kwargs.setdefault("timeout", get_request_timeout(config))
+            response = get_http_client(config).request(method, url, **kwargs)
+    except (req_exceptions.ConnectionError, req_exceptions.Timeout, ConnectionResetError):
+        if breaker:
+            breaker.record_failure()
+        raise
+    if breaker:
+        if response.status_code >= 500:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+    return response
+
+
+operation_registry = dict()
+
+
+def load_operation_registry(info_json):
+    """Index the info.json operations once so that each execution is a dictionary lookup"""
+    registry = dict()
+    for action_info in info_json.get("operations", []):
+        operation = action_info["operation"]
+        registry[operation] = dict(
+            action_info,
+            action_category=ACTION_CATEGORIES.get(operation),
+            page_size=PAGE_SIZES.get(ACTION_CATEGORIES.get(operation), 0),
+            handler=operation_sym.get(operation)
+        )
+    operation_registry.clear()
+    operation_registry.update(registry)
+    return operation_registry
+
+
+def get_curr_oper_info(info_json, action):
+    if not operation_registry:
+        load_operation_registry(info_json)
+    operation_info = operation_registry.get(action)
+    if operation_info is None:
+        logger.error("Unsupported operation: {0}".format(action))
+        raise ConnectorError("Unsupported operation: {0}".format(action))
+    return operation_info
+
+
+def run_operation(config, operation, params):
+    """Run another action of this connector, dispatched the same way as ThreatStream.execute"""
+    operation_info = operation_registry.get(operation)
+    if operation_info is None:
+        raise ConnectorError("Unsupported operation: {0}".format(operation))
+    if operation_info["handler_method"] is False:
+        return api_request(config, params, operation_info)
+    return operation_info["handler"](config, params)
+
+
+def get_output_fields(params):
+    output_fields = params.get("output_fields") if params else None
+    if isinstance(output_fields, str):
+        output_fields = output_fields.split(",")
+    if output_fields:
+        return [field.strip() for field in output_fields if field and field.strip()]
+    return None
+
+
+def project_object(obj, output_fields):
+    projected = dict()
+    for field in output_fields:
+        keys = field.split(".")
+        value = obj
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in keys[:-1]:
+                target = target.setdefault(key, dict())
+            target[keys[-1]] = value
+    return projected
+
+
+def decode_response(response, output_fields=None):
+    """Decode a JSON response, keeping only the requested fields of each intelligence object"""
+    resp_json = json_loads(response.content)
+    if output_fields and isinstance(resp_json, dict) and isinstance(resp_json.get("objects"), list):
+        resp_json["objects"] = [project_object(obj, output_fields) for obj in resp_json["objects"]]
+    return resp_json
 
 
 def generate_payload_filter(config, param, itype):
@@ -171,7 +782,8 @@ def get_all_record(resp_json, params, config):
         if resp_json["meta"]["total_count"] != 0:
             if "record_number" in params:
                 if params.get("record_number") == "Fetch All Records":
-                    make_rest_call(resp_json["meta"]["next"], config, resp_json)
+                    make_rest_call(resp_json["meta"]["next"], config, resp_json,
+                                   output_fields=get_output_fields(params))
 
             return resp_json
 
@@ -206,28 +818,144 @@ def parse_response(resp_json, params, operation_details, config):
         raise ConnectorError(err)
 
 
-def make_rest_call(endpoint, config, result):
-    server_url = config.get("base_url")
-    if not server_url.startswith("https://"):
-        server_url = "https://" + server_url
+learned_page_sizes = dict()
+timed_out_page_sizes = dict()
+learned_page_sizes_lock = threading.Lock()
 
-    endpoint_url = server_url + endpoint
-    try:
-        response = request(
-            "GET",
-            endpoint_url,
-            params=generate_payload(config, None),
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
-        )
-        if response.status_code == 200:
-            resp_json = response.json()
 
-            result["objects"] = result["objects"] + resp_json.get("objects", None)
-            result["meta"] = resp_json.get("meta", None)
-            if resp_json and resp_json["meta"]["next"]:
-                make_rest_call(resp_json["meta"]["next"], config, result)
-        else:
+def is_adaptive_paging(config):
+    return config.get("adaptive_paging") is True
+
+
+def get_page_size_key(config, endpoint):
+    return get_config_key(config), urlsplit(endpoint).path
+
+
+def get_adaptive_page_size(config, endpoint):
+    with learned_page_sizes_lock:
+        return learned_page_sizes.get(get_page_size_key(config, endpoint), INITIAL_PAGE_SIZE)
+
+
+def update_adaptive_page_size(config, endpoint, page_size, elapsed, content_length, record_count):
+    """Scale the page size towards the target page time, by at most a factor of two per page"""
+    target_page_time = get_config_int(config, "target_page_time", TARGET_PAGE_TIME)
+    scale = min(max(target_page_time / max(elapsed, 0.001), 0.5), 2.0)
+    if record_count < page_size:
+        # A short (last) page does not show how a full page would perform
+        scale = min(scale, 1.0)
+    if content_length:
+        scale = min(scale, MAX_PAGE_BYTES / float(content_length))
+    new_page_size = int(min(max(page_size * scale, MIN_PAGE_SIZE), MAX_PAGE_SIZE))
+    with learned_page_sizes_lock:
+        timed_out_page_size = timed_out_page_sizes.get(get_page_size_key(config, endpoint))
+        if timed_out_page_size:
+            # Do not grow back to a page size that has already timed out
+            new_page_size = max(min(new_page_size, timed_out_page_size * 3 // 4), MIN_PAGE_SIZE)
+        learned_page_sizes[get_page_size_key(config, endpoint)] = new_page_size
+    logger.debug("Page of {0} records took {1:.2f} seconds, next page size is {2}".format(
+        page_size, elapsed, new_page_size))
+    return new_page_size
+
+
+def reduce_adaptive_page_size(config, endpoint, page_size):
+    new_page_size = max(int(page_size) // 2, MIN_PAGE_SIZE)
+    with learned_page_sizes_lock:
+        learned_page_sizes[get_page_size_key(config, endpoint)] = new_page_size
+        timed_out_page_sizes[get_page_size_key(config, endpoint)] = int(page_size)
+    logger.warning("Page of {0} records timed out, retrying with {1} records".format(page_size, new_page_size))
+    return new_page_size
+
+
+def set_page_limit(endpoint, limit):
+    parts = urlsplit(endpoint)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True) if key != "limit"]
+    query.append(("limit", str(limit)))
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def set_page_offset(endpoint, limit, offset):
+    parts = urlsplit(endpoint)
+    query = [(key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+             if key not in ("limit", "offset")]
+    query.extend([("limit", str(limit)), ("offset", str(offset))])
+    return urlunsplit(parts._replace(query=urlencode(query)))
+
+
+def get_page(endpoint, config, output_fields=None):
+    server_url = check_server_url(config.get("base_url"))
+    response = send_request(config, "GET", server_url + endpoint, params=generate_payload(config, None))
+    if response.status_code != 200:
+        logger.error(
+            "Failure: get_page: Status: {0} {1}".format(str(response.status_code), str(response.text))
+        )
+        raise ConnectorError("Status: {0} {1}".format(str(response.status_code), str(response.text)))
+    return decode_response(response, output_fields)
+
+
+def get_all_pages_concurrently(config, endpoints, page_size=PAGE_SIZES["tb"], output_fields=None):
+    """Fetch every page of several paginated endpoints. The first page of each endpoint gives its total count,
+    the remaining pages are then requested by offset, all in one bounded pool.
+    Returns a (objects, total_count, error) tuple per endpoint, in the order of the endpoints"""
+    max_workers = get_max_workers(config)
+    first_pages = run_concurrently(
+        lambda endpoint: get_page(set_page_offset(endpoint, page_size, 0), config, output_fields),
+        endpoints, max_workers
+    )
+    results = list()
+    remaining = list()
+    for index, (endpoint, (page, error)) in enumerate(zip(endpoints, first_pages)):
+        if error:
+            results.append([[], 0, error])
+            continue
+        meta = page.get("meta") or {}
+        objects = list(page.get("objects") or [])
+        total_count = meta.get("total_count") or 0
+        results.append([objects, total_count, None])
+        # The server can cap the page size below the requested one, so the offsets of the other pages are
+        # stepped by the size of the page it actually returned
+        stride = page_size
+        if isinstance(meta.get("limit"), int) and 0 < meta["limit"] < stride:
+            stride = meta["limit"]
+        if 0 < len(objects) < min(stride, total_count):
+            stride = len(objects)
+        remaining.extend((index, endpoint, offset, stride)
+                         for offset in range(len(objects) or stride, total_count, stride))
+
+    pages = run_concurrently(
+        lambda item: get_page(set_page_offset(item[1], item[3], item[2]), config, output_fields),
+        remaining, max_workers
+    )
+    # Pages are merged in offset order as run_concurrently keeps the order of its items
+    for (index, endpoint, offset, stride), (page, error) in zip(remaining, pages):
+        if error:
+            results[index][2] = results[index][2] or error
+            continue
+        results[index][0].extend(page.get("objects") or [])
+    return [tuple(result) for result in results]
+
+
+def get_next_pages(endpoint, config, output_fields=None):
+    """Yield the decoded pages of a paginated result, starting from its meta.next endpoint"""
+    server_url = check_server_url(config.get("base_url"))
+    adaptive_paging = is_adaptive_paging(config)
+    while endpoint:
+        if adaptive_paging:
+            page_size = get_adaptive_page_size(config, endpoint)
+            endpoint = set_page_limit(endpoint, page_size)
+        started = monotonic()
+        try:
+            response = send_request(
+                config,
+                "GET",
+                server_url + endpoint,
+                params=generate_payload(config, None)
+            )
+        except req_exceptions.ReadTimeout:
+            if not adaptive_paging or page_size <= MIN_PAGE_SIZE:
+                raise
+            reduce_adaptive_page_size(config, endpoint, page_size)
+            continue
+        if response.status_code != 200:
             logger.error(
                 "Failure: make_rest_call: Status: {0} {1}".format(
                     str(response.status_code), str(response.text)
@@ -236,12 +964,389 @@ def make_rest_call(endpoint, config, result):
             raise ConnectorError(
                 "Status: {0} {1}".format(str(response.status_code), str(response.text))
             )
+        elapsed = monotonic() - started
+        resp_json = decode_response(response, output_fields)
+        if adaptive_paging:
+            update_adaptive_page_size(config, endpoint, page_size, elapsed, len(response.content),
+                                      len(resp_json.get("objects") or []))
+        yield resp_json
+        endpoint = (resp_json.get("meta") or {}).get("next")
+
+
+def make_rest_call(endpoint, config, result, output_fields=None):
+    try:
+        for resp_json in get_next_pages(endpoint, config, output_fields):
+            result["objects"].extend(resp_json.get("objects") or [])
+            result["meta"] = resp_json.get("meta", None)
 
     except Exception as err:
         logger.error("Failure: make_rest_call: {0}".format(str(err)))
         raise ConnectorError("{0}".format(str(err)))
 
 
+reputation_cache = dict()
+reputation_cache_lock = threading.Lock()
+cache_warmers = dict()
+cache_warmers_lock = threading.Lock()
+materialized_query_locks = dict()
+materialized_query_locks_lock = threading.Lock()
+
+
+def get_reputation_cache_key(config, itype, value):
+    value = str(value).strip()
+    if itype != "url":
+        value = value.lower()
+    return get_config_key(config), itype, value
+
+
+def get_cached_reputation(config, itype, value):
+    ttl = get_config_int(config, "reputation_cache_ttl", 0)
+    if ttl <= 0 or value in (None, ""):
+        return None
+    key = get_reputation_cache_key(config, itype, value)
+    with reputation_cache_lock:
+        entry = reputation_cache.get(key)
+        if entry and entry[0] < monotonic():
+            reputation_cache.pop(key, None)
+            entry = None
+    return entry[1] if entry else None
+
+
+def set_cached_reputations(config, entries):
+    """Store lists of intelligence objects in the reputation cache, keyed by (itype, value)"""
+    ttl = get_config_int(config, "reputation_cache_ttl", 0)
+    if ttl <= 0:
+        return
+    expires_at = monotonic() + ttl
+    with reputation_cache_lock:
+        for (itype, value), objects in entries.items():
+            key = get_reputation_cache_key(config, itype, value)
+            reputation_cache.pop(key, None)
+            reputation_cache[key] = (expires_at, objects)
+        # Entries are kept in insertion order, so the least recently stored entries are evicted first
+        while len(reputation_cache) > REPUTATION_CACHE_MAX_SIZE:
+            reputation_cache.pop(next(iter(reputation_cache)))
+
+
+def get_cached_reputation_response(config, params, itype):
+    if params.get("filter_option") != "Exact" or params.get("offset") or params.get("record_number") == "Fetch All Records":
+        return None
+    objects = get_cached_reputation(config, itype, params.get("value"))
+    if objects is None:
+        return None
+    limit = int(params.get("limit") or 0) or MAX_PAGE_SIZE
+    if len(objects) > limit:
+        # The lookup returns more than one page, which is left to ThreatStream to paginate
+        return None
+    output_fields = get_output_fields(params)
+    page = objects[:limit]
+    if output_fields:
+        page = [project_object(obj, output_fields) for obj in page]
+    return {
+        "meta": {"limit": limit, "next": None, "offset": 0, "previous": None, "total_count": len(objects)},
+        "objects": page
+    }
+
+
+def get_exact_reputation(config, itype, value):
+    """Run the exact-match reputation lookup of an indicator and return all its intelligence objects"""
+    query = {"type": itype, "value": value, "update_id__gt": 0, "order_by": "update_id", "limit": MAX_PAGE_SIZE}
+    return get_all_pages("/api/v2/intelligence/?" + urlencode(query), config)[0]
+
+
+def warm_reputation_cache(config):
+    """Find the indicators of recently updated, high-confidence active intelligence and store the results of
+    their exact-match reputation lookups in the reputation cache"""
+    min_confidence = get_config_int(config, "cache_warming_min_confidence", CACHE_WARMING_MIN_CONFIDENCE)
+    lookback = get_config_int(config, "cache_warming_lookback", CACHE_WARMING_LOOKBACK)
+    max_records = get_config_int(config, "cache_warming_max_records", CACHE_WARMING_MAX_RECORDS)
+    requests_per_second = get_config_int(config, "cache_warming_requests_per_second",
+                                         CACHE_WARMING_REQUESTS_PER_SECOND)
+    itypes = set(itype_dict.values())
+    query = {
+        "status": "active",
+        "confidence__gte": min_confidence,
+        "modified_ts__gte": (datetime.utcnow() - timedelta(hours=lookback)).strftime("%Y-%m-%dT%H:%M:%S"),
+        "update_id__gt": 0,
+        "order_by": "update_id",
+        "limit": min(max_records, PAGE_SIZES["tb"])
+    }
+    indicators = dict()
+    for page in get_next_pages("/api/v2/intelligence/?" + urlencode(query), config, ["type", "value"]):
+        for obj in page.get("objects") or []:
+            if obj.get("type") in itypes and obj.get("value") and len(indicators) < max_records:
+                indicators.setdefault(get_reputation_cache_key(config, obj["type"], obj["value"]),
+                                      (obj["type"], obj["value"]))
+        if len(indicators) >= max_records:
+            break
+
+    # The recent intelligence only identifies the hot indicators; each one is looked up the way the reputation
+    # actions do, so that the cache holds their complete results and not only the recent, active records
+    indicators = list(indicators.values())
+    pacing_lock = threading.Lock()
+    next_lookup_at = [monotonic()]
+
+    def lookup(indicator):
+        # The lookups of a cycle are spread out, so that warming does not burst the ThreatStream API
+        if requests_per_second > 0:
+            with pacing_lock:
+                start_at = max(monotonic(), next_lookup_at[0])
+                next_lookup_at[0] = start_at + 1.0 / requests_per_second
+            if start_at > monotonic():
+                wait_before_retry(start_at - monotonic())
+        return get_exact_reputation(config, *indicator)
+
+    entries = dict()
+    failed_count = 0
+    for indicator, (objects, error) in zip(indicators, run_concurrently(lookup, indicators,
+                                                                       get_max_workers(config))):
+        if error:
+            failed_count += 1
+        else:
+            entries[indicator] = objects
+    set_cached_reputations(config, entries)
+    logger.info("Warmed the reputation cache with {0} indicators, {1} lookups failed".format(
+        len(entries), failed_count))
+    return len(entries)
+
+
+def is_cache_warming(config):
+    return config.get("cache_warming") is True and get_config_int(config, "reputation_cache_ttl", 0) > 0
+
+
+def run_cache_warmer(config, generation):
+    try:
+        with operation_context(config, "warm_reputation_cache"):
+            warm_reputation_cache(config)
+    except Exception as err:
+        logger.error("Failed to warm the reputation cache: {0}".format(str(err)))
+    finally:
+        schedule_cache_warmer(config, generation)
+
+
+def schedule_cache_warmer(config, generation, delay=None):
+    key = get_config_key(config)
+    with cache_warmers_lock:
+        current = cache_warmers.get(key)
+        if not current or current[0] != generation:
+            return
+        if delay is None:
+            delay = get_config_int(config, "cache_warming_interval", CACHE_WARMING_INTERVAL) * 60
+        timer = threading.Timer(max(delay, 60), run_cache_warmer, args=(config, generation))
+        timer.daemon = True
+        cache_warmers[key] = (generation, timer)
+        timer.start()
+
+
+def start_cache_warmer(config):
+    """Warm the reputation cache of a configuration now and then on its warming interval"""
+    stop_cache_warmer(config)
+    if not is_cache_warming(config):
+        return
+    key = get_config_key(config)
+    generation = object()
+    with cache_warmers_lock:
+        cache_warmers[key] = (generation, None)
+    thread = threading.Thread(target=run_cache_warmer, args=(dict(config), generation))
+    thread.daemon = True
+    thread.start()
+
+
+def stop_cache_warmer(config):
+    try:
+        key = get_config_key(config)
+    except Exception:
+        return
+    with cache_warmers_lock:
+        generation, timer = cache_warmers.pop(key, (None, None))
+    if timer:
+        timer.cancel()
+
+
+class JobJournal(object):
+    """Persists the progress of a long-running operation under a job ID, so that a rerun resumes from it"""
+
+    def __init__(self, job_id, operation, params, config):
+        job_id = str(job_id).strip()
+        if not re.match(r"^[A-Za-z0-9_.-]{1,128}$", job_id):
+            raise ConnectorError("Invalid job ID: {0}. Use letters, digits, '.', '_' or '-'".format(job_id))
+        os.makedirs(JOB_JOURNAL_DIR, exist_ok=True)
+        remove_expired_files(JOB_JOURNAL_DIR, JOB_JOURNAL_RETENTION)
+        self.journal_path = join(JOB_JOURNAL_DIR, "{0}.json".format(job_id))
+        self.objects_path = join(JOB_JOURNAL_DIR, "{0}.ndjson".format(job_id))
+        # The server and user are part of the fingerprint, so that a job ID reused with another configuration
+        # does not resume the job of a different ThreatStream instance
+        fingerprint = hashlib.sha256(json.dumps(
+            {"config": get_config_key(config), "params": {k: v for k, v in params.items() if k != "job_id"}},
+            sort_keys=True, default=str
+        ).encode("utf-8")).hexdigest()
+        self.state = {"job_id": job_id, "operation": operation, "fingerprint": fingerprint, "status": "running"}
+        if exists(self.journal_path):
+            with open(self.journal_path, "r") as journal_file:
+                state = json.load(journal_file)
+            if state.get("operation") != operation or state.get("fingerprint") != fingerprint:
+                raise ConnectorError(
+                    "Job ID {0} was started by a different action, configuration, or parameters".format(job_id))
+            self.state = state
+            logger.info("Resuming job {0} from its journal".format(job_id))
+        # Drop any objects written after the last checkpoint, they are fetched again
+        if exists(self.objects_path):
+            with open(self.objects_path, "r+b") as objects_file:
+                objects_file.truncate(self.state.get("objects_size", 0))
+
+    def save(self):
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w") as journal_file:
+            json.dump(self.state, journal_file, default=_json_fallback)
+        os.replace(temp_path, self.journal_path)
+
+    def add_page(self, page):
+        with open(self.objects_path, "ab") as objects_file:
+            for obj in page.get("objects") or []:
+                objects_file.write((json.dumps(obj, default=_json_fallback) + "\n").encode("utf-8"))
+            self.state["objects_size"] = objects_file.tell()
+        self.state["meta"] = page.get("meta")
+        self.state["next"] = (page.get("meta") or {}).get("next")
+        self.state["page_count"] = self.state.get("page_count", 0) + 1
+        self.save()
+
+    def read_objects(self):
+        if not exists(self.objects_path):
+            return []
+        with open(self.objects_path, "r", encoding="utf-8") as objects_file:
+            return [json_loads(line) for line in objects_file if line.strip()]
+
+    def complete(self, keep_journal=False):
+        self.state["status"] = "completed"
+        self.state.pop("next", None)
+        remove_temp_file(self.objects_path)
+        if keep_journal:
+            self.save()
+        else:
+            remove_temp_file(self.journal_path)
+
+
+def remove_expired_files(directory, retention):
+    """Remove the files of a state directory that were not updated for the retention period, in days"""
+    expires_before = time() - retention * 24 * 60 * 60
+    for file_name in os.listdir(directory):
+        file_path = join(directory, file_name)
+        try:
+            if os.path.getmtime(file_path) < expires_before:
+                os.remove(file_path)
+        except OSError:
+            pass
+
+
+def fetch_all_with_journal(config, params, job_journal, resp_json=None):
+    """Fetch the remaining pages of a Fetch All Records action, checkpointing each page in the job journal"""
+    try:
+        # The first page is only recorded once; a journal that already has pages continues from its next page
+        if resp_json is not None and not job_journal.state.get("page_count"):
+            job_journal.add_page(resp_json)
+        next_page = job_journal.state.get("next")
+        if next_page:
+            for page in get_next_pages(next_page, config, get_output_fields(params)):
+                job_journal.add_page(page)
+        result = {"meta": job_journal.state.get("meta"), "objects": job_journal.read_objects()}
+        job_journal.complete()
+        return result
+    except Exception as err:
+        logger.error("Failure: fetch_all_with_journal: {0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
+def flatten_object(obj, parent_key=""):
+    flat = dict()
+    for key, value in obj.items():
+        flat_key = "{0}.{1}".format(parent_key, key) if parent_key else key
+        if isinstance(value, dict):
+            flat.update(flatten_object(value, flat_key))
+        elif isinstance(value, list):
+            flat[flat_key] = json.dumps(value, default=_json_fallback)
+        else:
+            flat[flat_key] = value
+    return flat
+
+
+def upload_file_to_cyops_attachment(file_name):
+    from connectors.cyops_utilities.builtins import upload_file_to_cyops
+
+    return upload_file_to_cyops(file_path=file_name, filename=file_name, name=file_name, create_attachment=True)
+
+
+def write_csv_rows(output_file, rows_file, fieldnames):
+    """Write the flattened rows spooled to an NDJSON file as CSV, with a header of all the columns seen"""
+    csv_writer = csv.DictWriter(output_file, fieldnames=fieldnames)
+    csv_writer.writeheader()
+    rows_file.seek(0)
+    for line in rows_file:
+        csv_writer.writerow(json_loads(line))
+
+
+def write_results_to_attachment(resp_json, params, config, operation):
+    """Stream all result pages to a compressed NDJSON or CSV file and upload it as a FortiSOAR attachment"""
+    file_format = OUTPUT_FILE_FORMATS.get(params.get("output_mode"))
+    output_fields = get_output_fields(params)
+    file_name = "threatstream_{0}_{1}.{2}.gz".format(
+        operation, datetime.now().strftime("%Y%m%d%H%M%S%f"), file_format
+    )
+    file_path = join("/tmp", file_name)
+    meta = resp_json.get("meta") or {}
+    pages = [resp_json]
+    if params.get("record_number") == "Fetch All Records" and meta.get("next"):
+        pages = chain(pages, get_next_pages(meta["next"], config, output_fields))
+
+    exported_count = 0
+    page_count = 0
+    # Without output fields the CSV columns are only known once every object was seen, so the flattened rows
+    # are spooled to a temporary file and the header is the union of their keys, in the order they appear.
+    rows_path = file_path + ".rows" if file_format == "csv" and not output_fields else None
+    fieldnames = dict()
+    try:
+        with gzip.open(file_path, "wt", encoding="utf-8", newline="") as output_file:
+            rows_file = open(rows_path, "w+", encoding="utf-8") if rows_path else None
+            try:
+                csv_writer = None
+                if file_format == "csv" and output_fields:
+                    csv_writer = csv.DictWriter(output_file, fieldnames=output_fields, extrasaction="ignore")
+                    csv_writer.writeheader()
+                for page in pages:
+                    page_count += 1
+                    for obj in page.get("objects") or []:
+                        if rows_file:
+                            row = flatten_object(obj)
+                            fieldnames.update(dict.fromkeys(row))
+                            rows_file.write(json.dumps(row, default=_json_fallback) + "\n")
+                        elif csv_writer:
+                            csv_writer.writerow(flatten_object(obj))
+                        else:
+                            output_file.write(json.dumps(obj, default=_json_fallback) + "\n")
+                        exported_count += 1
+                if rows_file:
+                    write_csv_rows(output_file, rows_file, list(fieldnames))
+            finally:
+                if rows_file:
+                    rows_file.close()
+        attachment = upload_file_to_cyops_attachment(file_name)
+        return {
+            "attachment_iri": attachment.get("@id"),
+            "file_name": file_name,
+            "file_format": file_format,
+            "total_count": meta.get("total_count"),
+            "exported_count": exported_count,
+            "page_count": page_count,
+        }
+    except ConnectorError:
+        raise
+    except Exception as err:
+        logger.error("Failure: write_results_to_attachment: {0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+    finally:
+        remove_temp_file(rows_path)
+        remove_temp_file(file_path)
+
+
 def from_cyops_download_file(iri):
     try:
         from integrations.crudhub import download_file_from_cyops
@@ -276,6 +1381,8 @@ def handle_date(days):
 
 
 def validate_input(itype, value):
+    import validators
+
     validator = {
         "domain": validators.domain,
         "email": validators.email,
@@ -290,26 +1397,35 @@ def validate_input(itype, value):
         return True
 
 
+def remove_temp_file(file_path):
+    if file_path and exists(file_path):
+        try:
+            os.remove(file_path)
+        except OSError as err:
+            logger.warning("Unable to remove file {0}: {1}".format(file_path, str(err)))
+
+
 def add_attachment_to_tb(tb_id, reference_id, config):
+    file_path = None
     try:
         server_url = check_server_url(config.get("base_url"))
         payload = generate_payload(config, None)
         file_path, file_name = from_cyops_download_file(reference_id)
         logger.info("Filename : {0} Filepath: {1}".format(file_name, file_path))
-        files = {
-            "attachment": (file_name, open(file_path, "rb")),
-            "filename": (None, file_name),
-        }
         endpoint_file = server_url + "/api/v1/tipreport/{0}/attachment/".format(tb_id)
 
-        response = request(
-            "POST",
-            endpoint_file,
-            params=payload,
-            files=files,
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
-        )
+        with open(file_path, "rb") as attachment:
+            files = {
+                "attachment": (file_name, attachment),
+                "filename": (None, file_name),
+            }
+            response = send_request(
+                config,
+                "POST",
+                endpoint_file,
+                params=payload,
+                files=files
+            )
         if response.status_code == 201:
             return response.json()
         else:
@@ -327,6 +1443,79 @@ def add_attachment_to_tb(tb_id, reference_id, config):
     except Exception as err:
         logger.error("{0}".format(str(err)))
         raise ConnectorError("{0}".format(str(err)))
+    finally:
+        remove_temp_file(file_path)
+
+
+def add_attachments_to_tb(tb_id, reference_ids, config):
+    """Download each attachment from FortiSOAR and upload it to the threat bulletin, several attachments at a time.
+    Returns the outcome of each attachment, in the order of the reference IDs"""
+    attachments = list()
+    responses = run_concurrently(
+        lambda reference_id: add_attachment_to_tb(tb_id, reference_id, config), reference_ids, get_max_workers(config)
+    )
+    for reference_id, (response, error) in zip(reference_ids, responses):
+        attachments.append({
+            "reference_id": reference_id,
+            "status": "Failed" if error else "Success",
+            "attachment": response,
+            "error": error
+        })
+    return attachments
+
+
+def add_threat_bulletin_attachments(tb_id, params, config, tb_response):
+    reference_ids = get_list_param(params.get("reference_id"))
+    if not reference_ids:
+        return tb_response
+    if len(reference_ids) == 1:
+        resp = add_attachment_to_tb(tb_id, reference_ids[0], config)
+        return {"attachment": resp, "threat_bulletin": tb_response}
+    return {"attachments": add_attachments_to_tb(tb_id, reference_ids, config), "threat_bulletin": tb_response}
+
+
+def get_import_chunks(data, files, chunk_size):
+    """Split the observable data or file of an import into chunks of at most chunk_size lines"""
+    if files:
+        file_name, content, content_type = files["file"]
+        lines = content.splitlines(True)
+        header = list()
+        if file_name.lower().endswith(".csv") and lines:
+            header = lines[:1]
+            lines = lines[1:]
+        # Observable data entered with the file is sent with the first chunk only
+        other_data = {k: v for k, v in data.items() if k != "datatext"}
+        return [
+            (data if i == 0 else other_data,
+             {"file": (file_name, "".join(header + lines[i:i + chunk_size]), content_type)})
+            for i in range(0, len(lines), chunk_size)
+        ] or [(data, files)]
+    observables = data.get("datatext", (None, ""))[1].splitlines(True)
+    return [
+        (dict(data, datatext=(None, "".join(observables[i:i + chunk_size]))), None)
+        for i in range(0, len(observables), chunk_size)
+    ] or [(data, files)]
+
+
+def submit_import_chunk(config, endpoint, payload, data, files):
+    response = send_request(
+        config,
+        "POST",
+        endpoint,
+        params=payload,
+        files=files,
+        data=data
+    )
+
+    if response.ok:
+        return response.json()
+    else:
+        try:
+            logger.error("Failure {0}: {1}".format(response.status_code, response.json()))
+            raise ConnectorError("Failure {0}: {1}".format(response.status_code, response.json()))
+        except (KeyError, json.decoder.JSONDecodeError) as error:
+            logger.error("Failed {0}: {1}".format(response.status_code, response.reason))
+            raise ConnectorError("Failure {0}: {1}".format(response.status_code, response.reason))
 
 
 def import_observables(config, params):
@@ -401,37 +1590,46 @@ def import_observables(config, params):
         files = None
         if reference_id:
             file_path, file_name = from_cyops_download_file(reference_id)
-            files = {
-                "file": (file_name, open(file_path, "r").read(), "text/csv")
-            }
+            with open(file_path, "r") as observables_file:
+                files = {
+                    "file": (file_name, observables_file.read(), "text/csv")
+                }
 
         endpoint = server_url + IMPORT_OBSERVABLES
-
-        response = request(
-            "POST",
-            endpoint,
-            params=payload,
-            files=files,
-            data=data,
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
-        )
-
-        if file_path and exists(file_path):
-            os.remove(file_path)
-
-        if response.ok:
-            return response.json()
-        else:
-            try:
-                logger.error("Failure {0}: {1}".format(response.status_code, response.json()))
-                raise ConnectorError("Failure {0}: {1}".format(response.status_code, response.json()))
-            except (KeyError, json.decoder.JSONDecodeError) as error:
-                logger.error("Failed {0}: {1}".format(response.status_code, response.reason))
-                raise ConnectorError("Failure {0}: {1}".format(response.status_code, response.reason))
+        chunk_size = int(params.get("chunk_size") or 0)
+        chunks = get_import_chunks(data, files, chunk_size) if chunk_size > 0 else [(data, files)]
+        job_journal = JobJournal(params.get("job_id"), "submit_observables", params, config) \
+            if params.get("job_id") not in (None, "") else None
+        submitted_chunks = job_journal.state.setdefault("chunks", {}) if job_journal else {}
+
+        import_jobs = list()
+        resumed_count = 0
+        for index, (chunk_data, chunk_files) in enumerate(chunks):
+            if str(index) in submitted_chunks:
+                import_jobs.append(submitted_chunks[str(index)])
+                resumed_count += 1
+                continue
+            import_job = submit_import_chunk(config, endpoint, payload, chunk_data, chunk_files)
+            import_jobs.append(import_job)
+            if job_journal:
+                submitted_chunks[str(index)] = import_job
+                job_journal.save()
+        if job_journal:
+            # The journal is kept so that a rerun with the same job ID does not import the observables again
+            job_journal.complete(keep_journal=True)
+
+        if chunk_size <= 0:
+            return import_jobs[0]
+        return {
+            "import_jobs": import_jobs,
+            "chunk_count": len(chunks),
+            "resumed_count": resumed_count
+        }
     except Exception as err:
         logger.error("{0}".format(str(err)))
         raise ConnectorError("{0}".format(str(err)))
+    finally:
+        remove_temp_file(file_path)
 
 
 def create_incident(config, params):
@@ -472,14 +1670,13 @@ def create_incident(config, params):
 
         header = {"Content-Type": "application/json"}
 
-        response = request(
+        response = send_request(
+            config,
             "POST",
             endpoint,
             headers=header,
             params=payload,
-            data=json.dumps(query_data),
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
+            data=json.dumps(query_data)
         )
         if response.status_code == 201:
             return response.json()
@@ -514,14 +1711,13 @@ def update_incident(config, params):
 
         header = {"Content-Type": "application/json"}
         result.pop("value")
-        response = request(
+        response = send_request(
+            config,
             "PATCH",
             endpoint,
             headers=header,
             params=payload,
-            data=json.dumps(result),
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
+            data=json.dumps(result)
         )
         if response.status_code == 202:
             return response.json()
@@ -586,8 +1782,21 @@ def fetch_incidents(config, params):
 def api_request(config, params, operation_details):
     try:
         server_url = check_server_url(config.get("base_url"))
-
-        if operation_details["operation"] in query_actions:
+        job_id = params.pop("job_id", None)
+        job_journal = None
+        if job_id not in (None, "") and params.get("record_number") == "Fetch All Records" \
+                and operation_details["operation"] in RAW_RESPONSE_ACTIONS \
+                and not params.get("output_mode") in OUTPUT_FILE_FORMATS:
+            job_journal = JobJournal(job_id, operation_details["operation"], params, config)
+            if job_journal.state.get("page_count"):
+                return fetch_all_with_journal(config, params, job_journal)
+        # Executions dispatched from the registry carry the precomputed values; handlers that build their own
+        # operation details fall back to the lookup tables.
+        action_category = operation_details.get("action_category") or ACTION_CATEGORIES.get(
+            operation_details["operation"])
+        page_size = operation_details.get("page_size", PAGE_SIZES.get(action_category, 0))
+
+        if action_category == "query":
             payload = generate_payload(config, None)
             param_value = params.get("value")
             endpoint = server_url + operation_details["endpoint"].format(
@@ -599,17 +1808,17 @@ def api_request(config, params, operation_details):
                     payload["limit"] = params.get("limit")
                     payload["offset"] = params.get("offset", 0)
                 else:
-                    payload["limit"] = 0
+                    payload["limit"] = page_size
                     payload["offset"] = 0
 
-        elif operation_details["operation"] in whois_action:
+        elif action_category == "whois":
             payload = generate_payload(config, None)
             param_value = params.get("value")
             endpoint = server_url + operation_details["endpoint"].format(
                 value=param_value
             )
 
-        elif operation_details["operation"] in action_list:
+        elif action_category == "list":
             payload = generate_payload(config, params)
             param_value = params.get("value")
             payload.pop("value")
@@ -623,7 +1832,7 @@ def api_request(config, params, operation_details):
                 value=param_value
             )
 
-        elif operation_details["operation"] in tb_action:
+        elif action_category == "tb":
             endpoint = config.get("base_url") + operation_details["endpoint"]
             payload = generate_payload(config, params)
             if "record_number" in params:
@@ -631,11 +1840,11 @@ def api_request(config, params, operation_details):
                     payload["limit"] = params.get("limit")
                     payload["offset"] = params.get("offset", 0)
                 else:
-                    payload["limit"] = 1000
+                    payload["limit"] = page_size
                     payload["offset"] = 0
                 payload.pop("record_number")
 
-        elif operation_details["operation"] in investigation_actions:
+        elif action_category == "investigation":
             base_url = check_server_url(config.get("base_url"))
             endpoint = base_url + operation_details["endpoint"]
             if operation_details["operation"] == 'list_investigations':
@@ -654,14 +1863,17 @@ def api_request(config, params, operation_details):
                     payload["limit"] = params.get("limit")
                     payload["offset"] = params.get("offset", 0)
                 else:
-                    payload["limit"] = 1000
+                    payload["limit"] = page_size
                     payload["offset"] = 0
                 payload.pop("record_number")
 
         else:
-            payload = generate_payload_filter(
-                config, params, itype_dict.get(operation_details["operation"])
-            )
+            itype = itype_dict.get(operation_details["operation"])
+            if action_category == "reputation":
+                cached_response = get_cached_reputation_response(config, params, itype)
+                if cached_response is not None:
+                    return cached_response
+            payload = generate_payload_filter(config, params, itype)
             endpoint = "{0}{1}".format(server_url, operation_details["endpoint"])
 
             if "record_number" in params:
@@ -669,32 +1881,47 @@ def api_request(config, params, operation_details):
                     payload["limit"] = params.get("limit")
                     payload["offset"] = params.get("offset", 0)
                 else:
-                    payload["limit"] = 0
+                    payload["limit"] = page_size
                     payload["offset"] = 0
 
+        adaptive_paging = is_adaptive_paging(config) and params.get("record_number") == "Fetch All Records" \
+            and "limit" in payload
+        if adaptive_paging:
+            payload["limit"] = get_adaptive_page_size(config, endpoint)
+
         # Common REST request query handler.
 
         retry_count = 0
         while retry_count < MAX_RETRY:
             try:
-                response = request(
+                started = monotonic()
+                response = send_request(
+                    config,
                     operation_details["http_method"],
                     endpoint,
-                    params=payload,
-                    verify=config.get("verify_ssl"),
-                    timeout=MAX_REQUEST_TIMEOUT
+                    params=payload
                 )
+                elapsed = monotonic() - started
                 if response.status_code in (200, 202):
-                    if operation_details["operation"] in list(
-                        set(resp_list) | set(query_actions)
-                    ):
-                        resp_json = response.json()
+                    resp_json = decode_response(response, get_output_fields(params))
+                    if adaptive_paging and isinstance(resp_json, dict):
+                        update_adaptive_page_size(config, endpoint, payload["limit"], elapsed,
+                                                  len(response.content), len(resp_json.get("objects") or []))
+                    if operation_details["operation"] in RAW_RESPONSE_ACTIONS:
+                        if params.get("output_mode") in OUTPUT_FILE_FORMATS:
+                            return write_results_to_attachment(resp_json, params, config,
+                                                               operation_details["operation"])
                         if params.get("record_number") == "Fetch All Records":
                             if not resp_json["meta"]["next"] is None:
+                                if job_journal:
+                                    return fetch_all_with_journal(config, params, job_journal, resp_json)
                                 return get_all_record(resp_json, params, config)
                         return resp_json
                     else:
-                        resp_json = response.json()
+                        if action_category == "reputation" and params.get("filter_option") == "Exact" \
+                                and not get_output_fields(params) and not payload.get("offset") \
+                                and (resp_json.get("meta") or {}).get("next") is None:
+                            set_cached_reputations(config, {(itype, params.get("value")): resp_json.get("objects") or []})
                         return parse_response(resp_json, params, operation_details, config)
 
                 elif response.status_code == 204:
@@ -714,13 +1941,15 @@ def api_request(config, params, operation_details):
             except (req_exceptions.ChunkedEncodingError, req_exceptions.ConnectionError,
                     req_exceptions.ReadTimeout, req_exceptions.ProxyError, ConnectionResetError) as ex:
                 retry_count += 1
+                if adaptive_paging and isinstance(ex, req_exceptions.ReadTimeout):
+                    payload["limit"] = reduce_adaptive_page_size(config, endpoint, payload["limit"])
 
                 if retry_count >= MAX_RETRY:
                     logger.error("Retry limit reached: {}".format(retry_count))
                     raise Exception(ex)
                 else:
                     logger.error("Retries attempted: {}".format(retry_count))
-                    sleep(DELAY_TIME)
+                    wait_before_retry(DELAY_TIME)
     except req_exceptions.SSLError:
         logger.error("An SSL error occurred")
         raise ConnectorError("An SSL error occurred")
@@ -758,6 +1987,18 @@ def check_health(config):
         raise ConnectorError(str(err))
 
 
+def get_request_statistics(config, params):
+    try:
+        return {
+            "max_concurrent_requests": get_config_int(config, "max_concurrent_requests", MAX_CONCURRENT_REQUESTS),
+            "max_requests_per_second": get_config_int(config, "max_requests_per_second", 0),
+            "request_queue": get_scheduler_stats(config)
+        }
+    except Exception as err:
+        logger.error("Failure {0}".format(str(err)))
+        raise ConnectorError(str(err))
+
+
 def get_status(config, params):
     try:
         if params.get("operation") == "update_incident":
@@ -826,6 +2067,35 @@ def list_threat_model_entity(config, params):
         raise ConnectorError(str(err))
 
 
+def expand_threat_bulletins(config, params):
+    try:
+        tb_ids = get_list_param(params.get("id"))
+        entity_types = params.get("entity_types")
+        if entity_types is None:
+            entity_types = THREAT_MODEL_ENTITY_TYPES
+        entity_types = get_list_param(entity_types)
+        include_observables = params.get("include_observables", True)
+
+        sections = list()
+        for tb_id in tb_ids:
+            for entity_type in entity_types:
+                sections.append((tb_id, entity_type.lower(), "/api/v1/tipreport/{0}/{1}/".format(tb_id, entity_type.lower())))
+            if include_observables:
+                sections.append((tb_id, "observables", "/api/v1/tipreport/{0}/intelligence/".format(tb_id)))
+
+        section_results = get_all_pages_concurrently(config, [endpoint for tb_id, name, endpoint in sections])
+        bulletins = {tb_id: {"id": tb_id, "errors": {}} for tb_id in tb_ids}
+        for (tb_id, name, endpoint), (objects, total_count, error) in zip(sections, section_results):
+            bulletin = bulletins[tb_id]
+            bulletin[name] = {"objects": objects, "total_count": total_count}
+            if error:
+                bulletin["errors"][name] = error
+        return {"threat_bulletins": list(bulletins.values()), "request_count": len(sections)}
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
 def create_threat_bulletin(config, params):
     try:
         server_url = check_server_url(config.get("base_url"))
@@ -854,23 +2124,17 @@ def create_threat_bulletin(config, params):
 
         header = {"Content-Type": "application/json"}
 
-        response = request(
+        response = send_request(
+            config,
             "POST",
             endpoint,
             headers=header,
             params=payload,
-            data=json.dumps(query_data),
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
+            data=json.dumps(query_data)
         )
         if response.status_code == 201:
-            reference_id = params.get("reference_id")
-            if not reference_id:
-                return response.json()
-            else:
-                tb_id = response.json().get("id")
-                resp = add_attachment_to_tb(tb_id, reference_id, config)
-                return {"attachment": resp, "threat_bulletin": response.json()}
+            tb_response = response.json()
+            return add_threat_bulletin_attachments(tb_response.get("id"), params, config, tb_response)
 
         else:
             logger.error(
@@ -894,6 +2158,7 @@ def update_threat_bulletin(config, params):
             result["status"] = PUBLISHED_STATUS_MAPPING.get(result["status"], result["status"])
         tb_id = params.get("tb_id")
         result.pop("tb_id")
+        result.pop("reference_id", None)
 
         if "fields" in result:
             extra_fields = result.pop("fields")
@@ -903,22 +2168,16 @@ def update_threat_bulletin(config, params):
         endpoint = server_url + "/api/v1/tipreport/{0}/".format(tb_id)
 
         header = {"Content-Type": "application/json"}
-        response = request(
+        response = send_request(
+            config,
             "PATCH",
             endpoint,
             headers=header,
             params=payload,
-            data=json.dumps(result),
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
+            data=json.dumps(result)
         )
         if response.status_code == 202:
-            reference_id = params.get("reference_id")
-            if not reference_id:
-                return response.json()
-            else:
-                resp = add_attachment_to_tb(tb_id, reference_id, config)
-                return {"attachment": resp, "threat_bulletin": response.json()}
+            return add_threat_bulletin_attachments(tb_id, params, config, response.json())
         else:
             logger.error(
                 "Failure {0}: {1}".format(response.status_code, response.reason)
@@ -932,7 +2191,59 @@ def update_threat_bulletin(config, params):
         raise ConnectorError("{0}".format(str(err)))
 
 
+def get_file_hashes(file_path):
+    """Compute the MD5, SHA-1 and SHA-256 of a file in one pass, reading it in fixed-size blocks"""
+    hashes = {"md5": hashlib.md5(), "sha1": hashlib.sha1(), "sha256": hashlib.sha256()}
+    with open(file_path, "rb") as sample_file:
+        for block in iter(lambda: sample_file.read(HASH_BLOCK_SIZE), b""):
+            for file_hash in hashes.values():
+                file_hash.update(block)
+    return {name: file_hash.hexdigest() for name, file_hash in hashes.items()}
+
+
+def normalize_url(url):
+    url = url.strip()
+    if "://" not in url:
+        url = "http://" + url
+    parts = urlsplit(url)
+    netloc = parts.hostname or ""
+    if parts.port and (parts.scheme, parts.port) not in (("http", 80), ("https", 443)):
+        netloc = "{0}:{1}".format(netloc, parts.port)
+    if parts.username:
+        netloc = "{0}@{1}".format(parts.username, netloc)
+    return urlunsplit((parts.scheme.lower(), netloc.lower(), parts.path or "/", parts.query, ""))
+
+
+def find_existing_sandbox_results(config, itype, values):
+    """Look up the intelligence and the sandbox reports that ThreatStream already has for a sample"""
+    def lookup(task):
+        source, value = task
+        if source == "intelligence":
+            endpoint = "/api/v2/intelligence/?" + urlencode(
+                {"type": itype, "value": value, "update_id__gt": 0, "order_by": "update_id", "limit": 0})
+        else:
+            endpoint = "/api/v1/submit/search/?" + urlencode({"q": value, "limit": 0})
+        return get_page(endpoint, config).get("objects") or []
+
+    tasks = [(source, value) for value in values for source in ("intelligence", "reports")]
+    existing = {"intelligence": [], "reports": []}
+    seen = {"intelligence": set(), "reports": set()}
+    for (source, value), (objects, error) in zip(tasks, run_concurrently(lookup, tasks, get_max_workers(config))):
+        if error:
+            # A failed lookup only means the sample is submitted again
+            logger.error("Failed to look up existing {0} for {1}: {2}".format(source, value, error))
+            continue
+        for obj in objects:
+            # The same record can be found by more than one of the values
+            if obj.get("id") is None or obj.get("id") not in seen[source]:
+                seen[source].add(obj.get("id"))
+                existing[source].append(obj)
+    return existing
+
+
 def submit_urls_files(config, params):
+    file_path = None
+    sample_file = None
     try:
         server_url = check_server_url(config.get("base_url"))
         endpoint = server_url + "/api/v1/submit/new/"
@@ -947,25 +2258,44 @@ def submit_urls_files(config, params):
         if radio_url:
             files["report_radio-url"] = (None, radio_url)
 
+        check_existing = params.get("check_existing") is True
+        sample = dict()
+        existing = dict()
         reference_id = params.get("reference_id")
         if reference_id:
             file_path, file_name = from_cyops_download_file(reference_id)
             logger.info("Filename : {0} Filepath: {1}".format(file_name, file_path))
-            files.setdefault("report_radio-file", (file_name, open(file_path, "rb")))
+            if check_existing:
+                sample = {"hashes": get_file_hashes(file_path)}
+                existing = find_existing_sandbox_results(config, "md5", list(sample["hashes"].values()))
+        elif radio_url and check_existing:
+            sample = {"url": normalize_url(radio_url)}
+            # Intelligence keeps URLs as they were entered, so the URL is looked up both as given and normalized
+            existing = find_existing_sandbox_results(config, "url", list(dict.fromkeys(
+                [radio_url.strip(), sample["url"]])))
+
+        if existing.get("intelligence") or existing.get("reports"):
+            logger.info("Skipping the sandbox submission, ThreatStream already has results for the sample")
+            return dict(sample, submitted=False, **existing)
+
+        if reference_id:
+            sample_file = open(file_path, "rb")
+            files.setdefault("report_radio-file", (file_name, sample_file))
 
         trusted_circles = params.get("trusted_circles")
         if trusted_circles:
             files["trusted_circles"] = (None, trusted_circles)
 
-        response = request(
+        response = send_request(
+            config,
             "POST",
             endpoint,
             params=payload,
-            files=files,
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
+            files=files
         )
         if response.status_code == 202:
+            if sample:
+                return dict(response.json(), submitted=True, **sample)
             return response.json()
         else:
             logger.error(
@@ -978,6 +2308,10 @@ def submit_urls_files(config, params):
     except Exception as err:
         logger.error("{0}".format(str(err)))
         raise ConnectorError("{0}".format(str(err)))
+    finally:
+        if sample_file:
+            sample_file.close()
+        remove_temp_file(file_path)
 
 
 def intelligence_enrichments(config, params):
@@ -1013,6 +2347,467 @@ def intelligence_enrichments(config, params):
         raise ConnectorError("{0}".format(str(err)))
 
 
+def get_indicator_type(value):
+    try:
+        ip_address(value)
+        return "IP"
+    except ValueError:
+        pass
+    if "://" in value:
+        return "URL"
+    if "@" in value:
+        return "Email"
+    if "/" in value:
+        try:
+            ip_network(value, strict=False)
+            return "CIDR"
+        except ValueError:
+            pass
+    if len(value) in HASH_TYPES and all(c in "0123456789abcdefABCDEF" for c in value):
+        return HASH_TYPES[len(value)]
+    return "Domain"
+
+
+def get_enrichment_requests(indicator_type, value):
+    """Map an indicator to the (source, operation, params) of every action that can enrich it"""
+    enrichments = [("Reputation", INDICATOR_REPUTATION_ACTIONS[indicator_type],
+                 {"value": value, "filter_option": "Exact", "validation": False})]
+    if indicator_type in ("IP", "Domain"):
+        enrichments.append(("Whois", "whois_{0}".format(indicator_type.lower()), {"value": value}))
+        enrichments.append(("Passive DNS", "intelligence_enrichments",
+                         {"services": "Passive DNS", "itype": indicator_type, "value": value}))
+    if indicator_type in ("IP", "Domain", "MD5"):
+        enrichments.append(("Recorded Future", "intelligence_enrichments",
+                         {"services": "Recorded Future", "itype": indicator_type, "value": value}))
+    if indicator_type == "IP":
+        enrichments.append(("Risk IQ", "intelligence_enrichments", {"services": "Risk IQ", "value": value}))
+    return enrichments
+
+
+def enrich_indicator(config, params):
+    try:
+        indicator_type = params.get("indicator_type") or "Auto Detect"
+        sources = params.get("sources")
+        sources = get_list_param(sources) if sources else list(ENRICHMENT_SOURCES)
+        source_timeout = int(params.get("source_timeout") or ENRICHMENT_SOURCE_TIMEOUT)
+
+        results = list()
+        tasks = list()
+        for value in get_list_param(params.get("value")):
+            value_type = get_indicator_type(value) if indicator_type == "Auto Detect" else indicator_type
+            if value_type not in INDICATOR_REPUTATION_ACTIONS:
+                raise ConnectorError("Invalid indicator type: {0}".format(value_type))
+            result = {"value": value, "indicator_type": value_type, "sources": {}}
+            results.append(result)
+            for source, operation, source_params in get_enrichment_requests(value_type, value):
+                if source in sources:
+                    tasks.append((result, source, operation, source_params))
+
+        def enrich(task):
+            result, source, operation, source_params = task
+            started = monotonic()
+            try:
+                # Each source gets its own deadline, bounded by the deadline of this operation
+                with operation_context(dict(config, operation_timeout=source_timeout)):
+                    return run_operation(config, operation, source_params), None, monotonic() - started
+            except Exception as err:
+                return None, str(err), monotonic() - started
+
+        failed_count = 0
+        for (result, source, operation, source_params), (response, _) in zip(
+                tasks, run_concurrently(enrich, tasks, get_max_workers(config))):
+            data, error, elapsed = response
+            result["sources"][source] = {
+                "status": "Failed" if error else "Success",
+                "data": data,
+                "error": error,
+                "elapsed_time": round(elapsed, 3)
+            }
+            if error:
+                failed_count += 1
+        return {"results": results, "request_count": len(tasks), "failed_count": failed_count}
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
+def correlate_incidents(config, params):
+    try:
+        values = list()
+        for value in get_list_param(params.get("value")):
+            if value not in values:
+                values.append(value)
+
+        def lookup(value):
+            # Incident lookups share the lookup cache of the reputation actions under their own type
+            incidents = get_cached_reputation(config, "incidents", value)
+            if incidents is not None:
+                return incidents, True
+            endpoint = "/api/v1/incident/associated_with_intelligence/?" + urlencode(
+                {"value": value, "limit": PAGE_SIZES["tb"]})
+            incidents = get_all_pages(endpoint, config)[0]
+            set_cached_reputations(config, {("incidents", value): incidents})
+            return incidents, False
+
+        indicators = dict()
+        incidents = dict()
+        cached_count = 0
+        for value, (response, error) in zip(values, run_concurrently(lookup, values, get_max_workers(config))):
+            if error:
+                indicators[value] = {"incident_ids": [], "total_count": 0, "error": error}
+                continue
+            value_incidents, cached = response
+            cached_count += 1 if cached else 0
+            indicators[value] = {"incident_ids": [], "total_count": len(value_incidents), "error": None}
+            for incident in value_incidents:
+                incident_id = incident.get("id")
+                indicators[value]["incident_ids"].append(incident_id)
+                entry = incidents.setdefault(str(incident_id), {"incident": incident, "indicators": []})
+                entry["indicators"].append(value)
+
+        return {
+            "indicators": indicators,
+            "incidents": incidents,
+            "lookup_count": len(values) - cached_count,
+            "cached_count": cached_count
+        }
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
+def batch_execute(config, params):
+    try:
+        items = params.get("operations") or []
+        if isinstance(items, str):
+            items = json.loads(items)
+        if not isinstance(items, list):
+            raise ConnectorError("Operations must be a list of objects with an operation and its params")
+        max_workers = get_max_workers(config)
+        if params.get("max_concurrency"):
+            max_workers = min(max_workers, int(params.get("max_concurrency")))
+
+        def execute_item(item):
+            if not isinstance(item, dict) or not item.get("operation"):
+                raise ConnectorError("Each item must specify an operation")
+            operation = item["operation"]
+            if operation in ("batch_execute", "check_health"):
+                raise ConnectorError("Operation {0} cannot be run in a batch".format(operation))
+            item_params = dict(item.get("params") or {})
+            started = monotonic()
+            try:
+                with operation_context(config, operation, item_params):
+                    return run_operation(config, operation, item_params), None, monotonic() - started
+            except Exception as err:
+                return None, str(err), monotonic() - started
+
+        results = list()
+        failed_count = 0
+        for index, (item, (response, error)) in enumerate(zip(items, run_concurrently(execute_item, items, max_workers))):
+            result, error, elapsed = response if response else (None, error, 0)
+            failed_count += 1 if error else 0
+            results.append({
+                "index": index,
+                "operation": item.get("operation") if isinstance(item, dict) else None,
+                "status": "Failed" if error else "Success",
+                "result": result,
+                "error": error,
+                "elapsed_time": round(elapsed, 3)
+            })
+        return {"results": results, "failed_count": failed_count}
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
+def get_field_value(obj, field):
+    for key in field.split("."):
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def aggregate_intelligence(config, params):
+    try:
+        group_by = params.get("group_by") or ["Indicator Type"]
+        if isinstance(group_by, str):
+            group_by = [field.strip() for field in group_by.split(",") if field.strip()]
+        fields = [AGGREGATION_FIELDS.get(field, field) for field in group_by]
+        bucket_size = int(params.get("confidence_bucket_size") or 10)
+        endpoint = INTELLIGENCE_QUERY_ENDPOINTS.get(params.get("query_type"), INTELLIGENCE_QUERY_ENDPOINTS[
+            "Filter Language Query"]).format(value=params.get("value", "")) + "&limit=0"
+
+        counts = {field: Counter() for field in fields}
+        groups = Counter()
+        total_count = 0
+        processed_count = 0
+        page_count = 0
+        for page in get_next_pages(endpoint, config, output_fields=fields):
+            page_count += 1
+            total_count = (page.get("meta") or {}).get("total_count", total_count)
+            for obj in page.get("objects") or []:
+                group_key = []
+                for field in fields:
+                    value = get_field_value(obj, field)
+                    if field == "confidence" and isinstance(value, (int, float)):
+                        bucket_start = int(value) // bucket_size * bucket_size
+                        value = "{0}-{1}".format(bucket_start, bucket_start + bucket_size - 1)
+                    value = "None" if value is None else str(value)
+                    counts[field][value] += 1
+                    group_key.append(value)
+                groups[tuple(group_key)] += 1
+                processed_count += 1
+
+        return {
+            "total_count": total_count,
+            "processed_count": processed_count,
+            "page_count": page_count,
+            "group_by": fields,
+            "counts": {field: dict(counter.most_common()) for field, counter in counts.items()},
+            "groups": [dict(zip(fields, key), count=count) for key, count in groups.most_common()]
+        }
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
+def normalize_query(query_type, value):
+    if query_type == "Advanced Search":
+        # Ordering and paging are set by the incremental fetch and would otherwise be sent twice
+        query_params = parse_qsl(value.strip().lstrip("?&"), keep_blank_values=True)
+        return urlencode(sorted(
+            (key, item) for key, item in query_params if key not in ("order_by", "limit", "offset")))
+    # Whitespace is collapsed outside quoted literals only, whose spacing is significant
+    parts = re.split(r"(\"(?:[^\"\\]|\\.)*\"|'(?:[^'\\]|\\.)*')", value.strip())
+    return "".join(part if index % 2 else re.sub(r"\s+", " ", part) for index, part in enumerate(parts))
+
+
+def selects_active_intelligence(query_type, query):
+    if query_type == "Advanced Search":
+        return ("status", "active") in parse_qsl(query, keep_blank_values=True)
+    return re.search(r"\bstatus\s*=\s*[\"']?active\b", query, re.IGNORECASE) is not None
+
+
+def get_materialized_query_path(config, query_type, query):
+    key = json.dumps([get_config_key(config), query_type, query])
+    return join(MATERIALIZED_QUERY_DIR, "{0}.json.gz".format(hashlib.sha256(key.encode("utf-8")).hexdigest()))
+
+
+def get_materialized_query_lock(path):
+    with materialized_query_locks_lock:
+        return materialized_query_locks.setdefault(path, threading.Lock())
+
+
+def load_materialized_query(path):
+    if not exists(path):
+        return None
+    try:
+        with gzip.open(path, "rb") as stored_file:
+            return json_loads(stored_file.read())
+    except (OSError, ValueError) as err:
+        logger.error("Discarding unreadable materialized query {0}: {1}".format(path, str(err)))
+        return None
+
+
+def save_materialized_query(path, stored):
+    temp_path = path + ".tmp"
+    with gzip.open(temp_path, "wt", encoding="utf-8") as stored_file:
+        json.dump(stored, stored_file, default=_json_fallback)
+    os.replace(temp_path, path)
+
+
+def is_expired_intelligence(obj, now):
+    expiration_ts = obj.get("expiration_ts")
+    return bool(expiration_ts) and str(expiration_ts)[:19] < now
+
+
+def materialized_query(config, params):
+    try:
+        query_type = params.get("query_type") or "Filter Language Query"
+        # The normalized query only identifies the stored result; the query is sent as it was entered
+        user_query = str(params.get("value") or "").strip()
+        query = normalize_query(query_type, user_query)
+        if not query:
+            raise ConnectorError("A query is required")
+        return_changes = params.get("return_mode") == "Changes Only"
+        max_age = int(params.get("max_age") if params.get("max_age") not in (None, "") else MATERIALIZED_QUERY_MAX_AGE)
+        os.makedirs(MATERIALIZED_QUERY_DIR, exist_ok=True)
+        path = get_materialized_query_path(config, query_type, query)
+
+        with get_materialized_query_lock(path):
+            remove_expired_files(MATERIALIZED_QUERY_DIR, MATERIALIZED_QUERY_RETENTION)
+            stored = load_materialized_query(path)
+            # A periodic full refresh drops the objects that were changed so that they no longer match the query
+            full_refresh = stored is None or params.get("force_refresh") is True or \
+                (max_age > 0 and time() - stored.get("refreshed_at", 0) > max_age * 60 * 60)
+            if full_refresh:
+                previous = stored.get("objects", {}) if stored and return_changes else {}
+                stored = {"query_type": query_type, "query": query, "high_water_mark": 0, "objects": {},
+                          "refreshed_at": time()}
+            else:
+                previous = None
+
+            high_water_mark = stored["high_water_mark"]
+            if query_type == "Advanced Search":
+                query_params = [(key, item) for key, item in parse_qsl(user_query.lstrip("?&"), keep_blank_values=True)
+                                if key not in ("order_by", "limit", "offset")]
+                # An update_id__gt of the query is the starting point of the incremental fetch
+                min_update_id = max([int(item) for key, item in query_params
+                                     if key == "update_id__gt" and item.isdigit()] or [0])
+                endpoint = "/api/v2/intelligence/?" + urlencode(
+                    [(key, item) for key, item in query_params if key != "update_id__gt"] + [
+                        ("update_id__gt", max(high_water_mark, min_update_id)), ("order_by", "update_id"),
+                        ("limit", PAGE_SIZES["tb"])])
+            else:
+                condition = "({0}) AND update_id>{1}".format(user_query, high_water_mark) if high_water_mark \
+                    else user_query
+                endpoint = "/api/v2/intelligence/?" + urlencode(
+                    {"q": condition, "order_by": "update_id", "limit": PAGE_SIZES["tb"]})
+
+            objects = stored["objects"]
+            added = dict()
+            updated = dict()
+            removed = list()
+            fetched_count = 0
+            now = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
+            for page in get_next_pages(endpoint, config):
+                for obj in page.get("objects") or []:
+                    fetched_count += 1
+                    obj_id = str(obj.get("id"))
+                    high_water_mark = max(high_water_mark, int(obj.get("update_id") or 0))
+                    known = objects.get(obj_id) or (previous or {}).get(obj_id)
+                    if known is None:
+                        added[obj_id] = obj
+                    elif known.get("update_id") != obj.get("update_id"):
+                        updated[obj_id] = obj
+                    objects[obj_id] = obj
+            # Intelligence that expired no longer matches a query for active intelligence, but it is not fetched
+            # again unless it was updated. Other queries keep it, since expired intelligence can match them.
+            if selects_active_intelligence(query_type, query):
+                for obj_id in [obj_id for obj_id, obj in objects.items() if is_expired_intelligence(obj, now)]:
+                    objects.pop(obj_id)
+                    updated.pop(obj_id, None)
+                    if added.pop(obj_id, None) is None:
+                        removed.append(obj_id)
+            if previous:
+                swept = set(removed)
+                removed.extend(obj_id for obj_id in previous if obj_id not in objects and obj_id not in swept)
+            stored["high_water_mark"] = high_water_mark
+            save_materialized_query(path, stored)
+
+        output_fields = get_output_fields(params)
+
+        def project(items):
+            return [project_object(obj, output_fields) for obj in items] if output_fields else list(items)
+
+        meta = {
+            "total_count": len(objects),
+            "fetched_count": fetched_count,
+            "high_water_mark": high_water_mark,
+            "full_refresh": full_refresh,
+            "refreshed_at": datetime.utcfromtimestamp(stored["refreshed_at"]).strftime("%Y-%m-%dT%H:%M:%S")
+        }
+        if return_changes:
+            return {"meta": meta, "added": project(added.values()), "updated": project(updated.values()),
+                    "removed": removed}
+        return {"meta": meta, "objects": project(objects.values())}
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
+def get_list_param(value):
+    if isinstance(value, str):
+        value = value.split(",")
+    if not value:
+        return []
+    if not isinstance(value, list):
+        value = [value]
+    return [str(item).strip() for item in value if item is not None and str(item).strip()]
+
+
+def get_all_pages(endpoint, config, output_fields=None):
+    objects = list()
+    total_count = 0
+    for page in get_next_pages(endpoint, config, output_fields):
+        total_count = (page.get("meta") or {}).get("total_count", total_count)
+        objects.extend(page.get("objects") or [])
+    return objects, total_count
+
+
+def ip_reputation_batch(config, params):
+    try:
+        prefix_length = int(str(params.get("prefix_length") or "/24").lstrip("/"))
+        output_fields = get_output_fields(params)
+        if output_fields and "value" not in output_fields:
+            output_fields = output_fields + ["value"]
+
+        results = dict()
+        invalid = list()
+        groups = dict()
+        for value in get_list_param(params.get("value")):
+            try:
+                ip = ip_address(value)
+            except ValueError:
+                invalid.append(value)
+                continue
+            results[str(ip)] = {"objects": [], "total_count": 0}
+            if ip.version == 4:
+                network = ip_network("{0}/{1}".format(ip, prefix_length), strict=False)
+                prefix = ".".join(str(network.network_address).split(".")[:prefix_length // 8]) + "."
+                groups.setdefault((network, prefix), []).append(ip)
+                # CIDR indicators covering the address can start outside the group prefix, for example 10.0.0.0/8
+                # for 10.1.2.3, so the CIDR indicators of its /8 are queried as well
+                cidr_network = ip_network("{0}/8".format(ip), strict=False)
+                groups.setdefault((cidr_network, str(ip).split(".")[0] + ".", "/"), []).append(ip)
+            else:
+                # IPv6 addresses are not grouped, the exact address is queried
+                groups.setdefault((ip_network(ip), None), []).append(ip)
+
+        def query_group(group):
+            network, prefix = group[:2]
+            query = {"type": "ip", "update_id__gt": 0, "order_by": "update_id", "limit": 0}
+            if prefix:
+                query["value__startswith"] = prefix
+            else:
+                query["value"] = str(network.network_address)
+            if len(group) > 2:
+                query["value__contains"] = group[2]
+            return get_all_pages("/api/v2/intelligence/?" + urlencode(query), config, output_fields)
+
+        group_results = run_concurrently(query_group, groups, get_max_workers(config))
+        errors = dict()
+        matched = dict((ip, set()) for ip in results)
+        for (group, ips), (group_result, error) in zip(groups.items(), group_results):
+            if error:
+                errors["{0}{1}".format(group[0], " CIDR indicators" if len(group) > 2 else "")] = error
+                continue
+            for obj in group_result[0]:
+                try:
+                    # Indicators can be single addresses or CIDR ranges covering several of the input addresses
+                    indicator = ip_network(str(obj.get("value")).strip(), strict=False)
+                except ValueError:
+                    continue
+                for ip in ips:
+                    # A CIDR indicator within the group prefix is returned by both queries
+                    obj_key = obj.get("id", id(obj))
+                    if ip in indicator and obj_key not in matched[str(ip)]:
+                        matched[str(ip)].add(obj_key)
+                        results[str(ip)]["objects"].append(obj)
+                        results[str(ip)]["total_count"] += 1
+
+        return {
+            "results": results,
+            "invalid_values": invalid,
+            "errors": errors,
+            "query_count": len(groups)
+        }
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
 def create_or_update_investigation(config, params):
     try:
         server_url = check_server_url(config.get("base_url"))
@@ -1031,14 +2826,13 @@ def create_or_update_investigation(config, params):
         if additional_attributes:
             payload.update(additional_attributes)
         header = {"Content-Type": "application/json"}
-        response = request(
+        response = send_request(
+            config,
             method,
             endpoint,
             headers=header,
             params=generate_payload(config, None),
-            json=payload,
-            verify=config.get("verify_ssl"),
-            timeout=MAX_REQUEST_TIMEOUT
+            json=payload
         )
         if response.ok:
             return response.json()
@@ -1054,6 +2848,82 @@ def create_or_update_investigation(config, params):
         raise ConnectorError("{0}".format(str(err)))
 
 
+def post_investigation_elements(config, elements):
+    server_url = check_server_url(config.get("base_url"))
+    response = send_request(
+        config,
+        "POST",
+        server_url + "/api/v1/investigationelement/",
+        headers={"Content-Type": "application/json"},
+        params=generate_payload(config, None),
+        json={"objects": elements}
+    )
+    if not response.ok:
+        raise ConnectorError("Failure {0}: {1}".format(response.status_code, response.text or response.reason))
+    return response
+
+
+def add_investigation_elements(config, params):
+    try:
+        investigation_id = params.get("investigation_id")
+        elements = params.get("elements") or []
+        if isinstance(elements, str):
+            elements = json.loads(elements)
+        if isinstance(elements, dict):
+            elements = [elements]
+        batch_size = get_config_int(params, "batch_size", INVESTIGATION_ELEMENT_BATCH_SIZE)
+        if batch_size < 1:
+            raise ConnectorError("Invalid value for batch_size: {0}. It must be at least 1".format(batch_size))
+        add_related_indicators = 1 if params.get("add_related_indicators") == "Yes" else 0
+        max_workers = get_max_workers(config)
+
+        failed = list()
+        objects = list()
+        for element in elements:
+            if not isinstance(element, dict) or not element.get("r_type") or element.get("r_id") in (None, ""):
+                failed.append({"element": element, "error": "Each element must specify an r_type and an r_id"})
+                continue
+            objects.append({
+                "r_type": str(element.get("r_type")).lower(),
+                "r_id": element.get("r_id"),
+                "investigation_id": investigation_id,
+                "add_related_indicators": add_related_indicators
+            })
+
+        batches = [objects[i:i + batch_size] for i in range(0, len(objects), batch_size)]
+        retry = list()
+        added_count = 0
+        for batch, (response, error) in zip(batches, run_concurrently(
+                lambda batch: post_investigation_elements(config, batch), batches, max_workers)):
+            if not error:
+                added_count += len(batch)
+            elif len(batch) > 1:
+                retry.extend(batch)
+            else:
+                failed.append({"element": batch[0], "error": error})
+        # Elements of a rejected batch are added one at a time, so that a single invalid element does not
+        # prevent the rest of its batch from being added and its own error can be reported
+        for element, (response, error) in zip(retry, run_concurrently(
+                lambda element: post_investigation_elements(config, [element]), retry, max_workers)):
+            if error:
+                failed.append({"element": element, "error": error})
+            else:
+                added_count += 1
+
+        read_endpoint = "/api/v1/investigationelement/?" + urlencode({"investigation_id": investigation_id})
+        element_objects, total_count, error = get_all_pages_concurrently(config, [read_endpoint])[0]
+        return {
+            "added_count": added_count,
+            "failed_count": len(failed),
+            "failed": failed,
+            "batch_count": len(batches),
+            "elements": {"objects": element_objects, "total_count": total_count, "error": error}
+        }
+    except Exception as err:
+        logger.error("{0}".format(str(err)))
+        raise ConnectorError("{0}".format(str(err)))
+
+
 operation_sym = {
     "create_incident": create_incident,
     "update_incident": update_incident,
@@ -1069,4 +2939,13 @@ operation_sym = {
     "intelligence_enrichments": intelligence_enrichments,
     "update_investigation": create_or_update_investigation,
     "create_investigation": create_or_update_investigation,
+    "aggregate_intelligence": aggregate_intelligence,
+    "ip_reputation_batch": ip_reputation_batch,
+    "expand_threat_bulletins": expand_threat_bulletins,
+    "add_investigation_elements": add_investigation_elements,
+    "enrich_indicator": enrich_indicator,
+    "correlate_incidents": correlate_incidents,
+    "materialized_query": materialized_query,
+    "batch_execute": batch_execute,
+    "get_request_statistics": get_request_statistics,
 }
\ No newline at end of file
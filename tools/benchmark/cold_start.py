@@ -0,0 +1,94 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc Copyright end
+"""
+# -----------------------------------------
+# Cold-start timing for the ThreatStream connector
+#
+# Starts a fresh interpreter for every run and times the connector import, the construction of ThreatStream
+# (which compiles the operation registry) and operation lookups. It also checks that the modules that are only
+# needed on some paths are not imported at startup. Run it where the FortiSOAR connector SDK is importable:
+#
+#   python tools/benchmark/cold_start.py --runs 10 --max-startup 1.0
+# -----------------------------------------
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAZY_MODULES = ["validators", "connectors.cyops_utilities.builtins"]
+
+MEASURE = """
+import json, sys
+from time import perf_counter
+started = perf_counter()
+from threatstream.connector import ThreatStream
+from threatstream.operations import get_curr_oper_info
+imported = perf_counter()
+with open({info_path!r}) as info_file:
+    info_json = json.load(info_file)
+connector = ThreatStream(info_json=info_json)
+constructed = perf_counter()
+operations = [action["operation"] for action in info_json["operations"]]
+for _ in range(100):
+    for operation in operations:
+        get_curr_oper_info(info_json, operation)
+looked_up = perf_counter()
+print(json.dumps({{
+    "import_seconds": imported - started,
+    "construct_seconds": constructed - imported,
+    "startup_seconds": constructed - started,
+    "lookup_microseconds": (looked_up - constructed) / (100 * len(operations)) * 1e6,
+    "eager_modules": [name for name in {lazy_modules!r} if name in sys.modules]
+}}))
+"""
+
+
+def measure_once():
+    code = MEASURE.format(info_path=os.path.join(REPO_DIR, "threatstream", "info.json"), lazy_modules=LAZY_MODULES)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_DIR, env.get("PYTHONPATH")]))
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    output = subprocess.run([sys.executable, "-c", code], env=env, check=True, capture_output=True, text=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold-start timing for the ThreatStream connector")
+    parser.add_argument("--runs", type=int, default=10, help="Number of fresh interpreters to time")
+    parser.add_argument("--max-startup", type=float, default=1.0,
+                        help="Maximum median seconds for the import and construction of the connector")
+    parser.add_argument("--max-lookup", type=float, default=5.0,
+                        help="Maximum median microseconds for one operation lookup")
+    args = parser.parse_args()
+
+    runs = [measure_once() for _ in range(args.runs)]
+    summary = dict(
+        (key, statistics.median(run[key] for run in runs))
+        for key in ("import_seconds", "construct_seconds", "startup_seconds", "lookup_microseconds")
+    )
+    eager_modules = sorted(set(name for run in runs for name in run["eager_modules"]))
+    for key, value in summary.items():
+        print("{0:<22} median {1:.4f}".format(key, value))
+
+    failures = list()
+    if summary["startup_seconds"] > args.max_startup:
+        failures.append("startup took {0:.3f}s, limit {1}s".format(summary["startup_seconds"], args.max_startup))
+    if summary["lookup_microseconds"] > args.max_lookup:
+        failures.append("operation lookup took {0:.2f}us, limit {1}us".format(
+            summary["lookup_microseconds"], args.max_lookup))
+    if eager_modules:
+        failures.append("imported at startup: {0}".format(", ".join(eager_modules)))
+    for failure in failures:
+        print("FAIL: {0}".format(failure))
+    print("Cold start {0}".format("FAILED" if failures else "PASSED"))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc Copyright end
+"""
+# -----------------------------------------
+# HTTP/1.1 and HTTP/2 transport benchmark for the ThreatStream connector
+#
+# Sends the same concurrent workload through operations.send_request with Use HTTP/2 cleared and selected, against
+# local TLS stand-ins for the ThreatStream API: the HTTP/1.1 stub server of tools/loadtest and an HTTP/2 server
+# built on the h2 package that serves the same responses. Throughput, latency and the number of connections
+# opened are reported for each protocol. Requires the FortiSOAR connector SDK, httpx and h2:
+#
+#   python tools/benchmark/http2_benchmark.py --requests 2000 --concurrency 20 --latency 0.05
+# -----------------------------------------
+
+import argparse
+import asyncio
+import json
+import os
+import ssl
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic
+from urllib.parse import urlsplit, parse_qsl
+
+TOOLS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+sys.path.insert(0, os.path.join(TOOLS_DIR, "loadtest"))
+sys.path.insert(0, REPO_DIR)
+
+from stub_server import ServerStats, generate_certificate, start_stub_server
+
+WORKLOAD = [
+    ("/api/v2/intelligence/", {"value": "10.0.1.5", "type": "ip", "update_id__gt": 0, "order_by": "update_id"}),
+    ("/api/v2/intelligence/", {"type": "ip", "limit": 100, "offset": 0}),
+    ("/api/v1/tipreport/", {"limit": 20, "offset": 0}),
+    ("/api/v1/pdns/ip/10.0.1.5/", {})
+]
+
+
+class H2Protocol(asyncio.Protocol):
+    def __init__(self, server):
+        import h2.config
+        import h2.connection
+        self.server = server
+        self.connection = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False))
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.server.stats.connection_opened()
+        self.connection.initiate_connection()
+        self.transport.write(self.connection.data_to_send())
+
+    def connection_lost(self, exc):
+        self.server.stats.connection_closed()
+
+    def data_received(self, data):
+        import h2.events
+        import h2.exceptions
+        try:
+            events = self.connection.receive_data(data)
+        except h2.exceptions.ProtocolError:
+            self.transport.write(self.connection.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                headers = dict((name.decode() if isinstance(name, bytes) else name,
+                                value.decode() if isinstance(value, bytes) else value)
+                               for name, value in event.headers)
+                self.server.stats.request_received()
+                asyncio.get_event_loop().call_later(self.server.latency, self.respond, event.stream_id,
+                                                    headers[":path"])
+        self.transport.write(self.connection.data_to_send())
+
+    def respond(self, stream_id, path):
+        import h2.exceptions
+        parts = urlsplit(path)
+        content = json.dumps(self.server.get_response(parts.path, dict(parse_qsl(parts.query)))).encode("utf-8")
+        try:
+            self.connection.send_headers(stream_id, [
+                (":status", "200"), ("content-type", "application/json"), ("content-length", str(len(content)))
+            ])
+            # Respect the flow control window of the client for large pages
+            offset = 0
+            while offset < len(content):
+                window = min(self.connection.local_flow_control_window(stream_id),
+                             self.connection.max_outbound_frame_size)
+                if window <= 0:
+                    asyncio.get_event_loop().call_later(0.001, self.send_remaining, stream_id, content[offset:])
+                    self.transport.write(self.connection.data_to_send())
+                    return
+                self.connection.send_data(stream_id, content[offset:offset + window])
+                offset += window
+            self.connection.end_stream(stream_id)
+        except h2.exceptions.StreamClosedError:
+            pass
+        self.transport.write(self.connection.data_to_send())
+
+    def send_remaining(self, stream_id, content):
+        import h2.exceptions
+        try:
+            window = min(self.connection.local_flow_control_window(stream_id),
+                         self.connection.max_outbound_frame_size)
+            if window > 0:
+                self.connection.send_data(stream_id, content[:window])
+                content = content[window:]
+            if content:
+                asyncio.get_event_loop().call_later(0.001, self.send_remaining, stream_id, content)
+            else:
+                self.connection.end_stream(stream_id)
+        except h2.exceptions.StreamClosedError:
+            pass
+        self.transport.write(self.connection.data_to_send())
+
+
+class H2StubServer(object):
+    """HTTP/2 over TLS stand-in that serves the responses of an HTTP/1.1 stub server"""
+
+    def __init__(self, cert_file, key_file, responder, latency=0.0):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        self.context.load_cert_chain(cert_file, key_file)
+        self.context.set_alpn_protocols(["h2"])
+        self.get_response = responder
+        self.latency = latency
+        self.stats = ServerStats()
+        self.loop = asyncio.new_event_loop()
+        self.port = None
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return "https://127.0.0.1:{0}".format(self.port)
+
+    def start(self):
+        started = threading.Event()
+
+        def serve():
+            asyncio.set_event_loop(self.loop)
+            server = self.loop.run_until_complete(self.loop.create_server(
+                lambda: H2Protocol(self), "127.0.0.1", 0, ssl=self.context))
+            self.port = server.sockets[0].getsockname()[1]
+            started.set()
+            self.loop.run_forever()
+            server.close()
+
+        self.thread = threading.Thread(target=serve, daemon=True)
+        self.thread.start()
+        started.wait()
+        return self
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_benchmark(server, use_http2, requests, concurrency):
+    from threatstream import operations
+    config = {
+        "base_url": server.base_url, "api_username": "benchmark", "api_key": "benchmark", "verify_ssl": False,
+        "use_http2": use_http2, "max_concurrent_requests": concurrency
+    }
+    latencies = list()
+    lock = threading.Lock()
+
+    def send(index):
+        path, query = WORKLOAD[index % len(WORKLOAD)]
+        started = monotonic()
+        response = operations.send_request(config, "GET", server.base_url + path,
+                                           params=dict(query, username="benchmark", api_key="benchmark"))
+        if response.status_code != 200:
+            raise RuntimeError("Unexpected status {0}".format(response.status_code))
+        with lock:
+            latencies.append(monotonic() - started)
+
+    # The first request of each protocol opens the connection and is not measured
+    send(0)
+    latencies.clear()
+    before = server.stats.snapshot()
+    started = monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, range(requests)))
+    elapsed = monotonic() - started
+    after = server.stats.snapshot()
+    return {
+        "protocol": "HTTP/2" if use_http2 else "HTTP/1.1",
+        "requests": requests,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "max_ms": round(max(latencies) * 1000, 2),
+        "connections_opened": after["total_connections"],
+        "peak_open_connections": after["peak_connections"],
+        "server_requests": after["requests"] - before["requests"]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP/1.1 and HTTP/2 transport benchmark")
+    parser.add_argument("--requests", type=int, default=2000, help="Number of measured requests per protocol")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="Number of concurrent requests, also used as Maximum Concurrent Requests")
+    parser.add_argument("--latency", type=float, default=0.05, help="Server response delay, in seconds")
+    parser.add_argument("--report", help="File to which the JSON results are written")
+    args = parser.parse_args()
+
+    # The certificate and its private key are only needed while the servers run
+    with tempfile.TemporaryDirectory(prefix="threatstream-benchmark-") as certificate_dir:
+        cert_file, key_file = generate_certificate(certificate_dir)
+        http1_server = start_stub_server(cert_file, key_file, latency=args.latency)
+        try:
+            http2_server = H2StubServer(cert_file, key_file, http1_server.get_response, latency=args.latency).start()
+            try:
+                results = [
+                    run_benchmark(http1_server, False, args.requests, args.concurrency),
+                    run_benchmark(http2_server, True, args.requests, args.concurrency)
+                ]
+            finally:
+                http2_server.stop()
+        finally:
+            http1_server.stop()
+
+    columns = ["protocol", "requests_per_second", "p50_ms", "p95_ms", "max_ms", "connections_opened",
+               "peak_open_connections"]
+    print("  ".join("{0:>21}".format(column) for column in columns))
+    for result in results:
+        print("  ".join("{0:>21}".format(result[column]) for column in columns))
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
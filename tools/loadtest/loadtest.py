@@ -0,0 +1,334 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc Copyright end
+"""
+# -----------------------------------------
+# Concurrency and soak load test for ThreatStream.execute
+#
+# Drives a weighted mix of connector operations from many threads, optionally spread over several processes,
+# against the local stub server in stub_server.py. Open file descriptors, memory, connections and errors are
+# sampled over time and compared with the limits in thresholds.json. The connector is imported as is, so this
+# must run in an environment that provides the FortiSOAR connector SDK (connectors, integrations and django).
+#
+#   python tools/loadtest/loadtest.py --workers 50 --duration 3600 --processes 4 --report loadtest.json
+# -----------------------------------------
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+from collections import defaultdict
+from time import monotonic, sleep
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(os.path.dirname(TOOLS_DIR))
+sys.path.insert(0, TOOLS_DIR)
+sys.path.insert(0, REPO_DIR)
+
+from stub_server import start_stub_server
+
+DEFAULT_MIX = [
+    {"operation": "ip_reputation", "weight": 30, "params": {"value": "10.0.1.5", "filter_option": "Exact"}},
+    {"operation": "domain_reputation", "weight": 10, "params": {"value": "example.com", "filter_option": "Exact"}},
+    {"operation": "whois_ip", "weight": 10, "params": {"value": "10.0.1.5"}},
+    {"operation": "advance_query", "weight": 5, "params": {"value": "type=ip", "record_number": "Fetch All Records"}},
+    {"operation": "list_threat_bulletins", "weight": 10,
+     "params": {"record_number": "Fetch Limited Records", "limit": 20, "offset": 0}},
+    {"operation": "create_threat_bulletin", "weight": 5,
+     "params": {"name": "load test", "is_public": False, "body_content_type": "Markdown",
+                "reference_id": "/api/3/attachments/loadtest"}},
+    {"operation": "submit_observables", "weight": 5,
+     "params": {"data": "10.0.1.5", "confidence": 50, "expiration_ts": "30 days", "classification": "Private"}},
+    {"operation": "submit_urls_files", "weight": 5,
+     "params": {"classification": "Private", "platform": "WINDOWS7", "detail": "load test",
+                "reference_id": "/api/3/attachments/loadtest"}}
+]
+
+SAMPLE_FILE_SIZE = 256 * 1024
+
+
+def count_open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def get_rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def install_download_stand_in(sample_path):
+    """Replace the FortiSOAR attachment download with a copy of a local file, so that the upload paths run
+    their real open, close and temporary file clean-up code"""
+    from threatstream import operations
+    counter = [0]
+    lock = threading.Lock()
+
+    def download(iri):
+        with lock:
+            counter[0] += 1
+            file_name = "threatstream-loadtest-{0}-{1}.bin".format(os.getpid(), counter[0])
+        file_path = os.path.join(tempfile.gettempdir(), file_name)
+        shutil.copyfile(sample_path, file_path)
+        return file_path, file_name
+
+    operations.from_cyops_download_file = download
+
+
+def run_workers(config, mix, threads, duration, warmup, sample_interval, sample_path, server=None):
+    """Run the operation mix from a number of threads in this process and return its measurements"""
+    from threatstream.connector import ThreatStream
+    with open(os.path.join(REPO_DIR, "threatstream", "info.json")) as info_file:
+        connector = ThreatStream(info_json=json.load(info_file))
+    install_download_stand_in(sample_path)
+
+    weights = [item.get("weight", 1) for item in mix]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    error_messages = defaultdict(int)
+    counts = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = monotonic() + duration
+    stop = threading.Event()
+
+    def worker():
+        while monotonic() < deadline:
+            item = random.choices(mix, weights)[0]
+            started = monotonic()
+            error = None
+            try:
+                connector.execute(dict(config), item["operation"], json.loads(json.dumps(item.get("params", {}))))
+            except Exception as err:
+                error = str(err)[:200]
+            elapsed = monotonic() - started
+            with lock:
+                counts["requests"] += 1
+                latencies[item["operation"]].append(elapsed)
+                if error:
+                    counts["errors"] += 1
+                    errors[item["operation"]] += 1
+                    error_messages[error] += 1
+
+    samples = list()
+    started = monotonic()
+
+    def sampler():
+        while not stop.is_set():
+            with lock:
+                sample = {"time": round(monotonic() - started, 1), "requests": counts["requests"],
+                          "errors": counts["errors"]}
+            sample.update(open_fds=count_open_fds(), rss_mb=round(get_rss_mb(), 1),
+                          threads=threading.active_count())
+            if server:
+                sample.update(server.stats.snapshot())
+            samples.append(sample)
+            stop.wait(sample_interval)
+
+    sampler_thread = threading.Thread(target=sampler, daemon=True)
+    sampler_thread.start()
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    sleep(min(warmup, duration))
+    baseline = {"open_fds": count_open_fds(), "rss_mb": get_rss_mb()}
+    for thread in workers:
+        thread.join()
+    # Let connections and files released by the last operations settle before the final measurement
+    sleep(1)
+    final = {"open_fds": count_open_fds(), "rss_mb": get_rss_mb()}
+    stop.set()
+    sampler_thread.join()
+
+    leaked_files = [name for name in os.listdir(tempfile.gettempdir())
+                    if name.startswith("threatstream-loadtest-{0}-".format(os.getpid()))]
+    return {
+        "pid": os.getpid(),
+        "requests": counts["requests"],
+        "errors": counts["errors"],
+        "latencies": dict(latencies),
+        "errors_by_operation": dict(errors),
+        "error_messages": dict(error_messages),
+        "fd_growth": final["open_fds"] - baseline["open_fds"] if baseline["open_fds"] is not None else None,
+        "memory_growth_mb": round(final["rss_mb"] - baseline["rss_mb"], 1),
+        "leaked_temp_files": len(leaked_files),
+        "samples": samples
+    }
+
+
+def run_process(arguments):
+    return run_workers(*arguments)
+
+
+def get_max_window_error_rate(samples):
+    rates = list()
+    for previous, current in zip(samples, samples[1:]):
+        requests = current["requests"] - previous["requests"]
+        if requests:
+            rates.append((current["errors"] - previous["errors"]) / float(requests))
+    return max(rates) if rates else 0.0
+
+
+def build_report(results, server_stats, thresholds, args):
+    requests = sum(result["requests"] for result in results)
+    errors = sum(result["errors"] for result in results)
+    latencies = defaultdict(list)
+    errors_by_operation = defaultdict(int)
+    error_messages = defaultdict(int)
+    for result in results:
+        for operation, values in result["latencies"].items():
+            latencies[operation].extend(values)
+        for operation, count in result["errors_by_operation"].items():
+            errors_by_operation[operation] += count
+        for message, count in result["error_messages"].items():
+            error_messages[message] += count
+    all_latencies = [value for values in latencies.values() for value in values]
+
+    metrics = {
+        "error_rate": errors / float(requests) if requests else 0.0,
+        "window_error_rate": max(get_max_window_error_rate(result["samples"]) for result in results),
+        "fd_growth": max((result["fd_growth"] or 0) for result in results),
+        "memory_growth_mb": max(result["memory_growth_mb"] for result in results),
+        "leaked_temp_files": sum(result["leaked_temp_files"] for result in results),
+        "peak_connections": server_stats["peak_connections"],
+        "connections_per_request": server_stats["total_connections"] / float(server_stats["requests"] or 1),
+        "p95_latency_seconds": percentile(all_latencies, 0.95) or 0.0
+    }
+    limits = {
+        "error_rate": "max_error_rate",
+        "window_error_rate": "max_window_error_rate",
+        "fd_growth": "max_fd_growth",
+        "memory_growth_mb": "max_memory_growth_mb",
+        "leaked_temp_files": "max_leaked_temp_files",
+        "peak_connections": "max_peak_connections",
+        "connections_per_request": "max_connections_per_request",
+        "p95_latency_seconds": "max_p95_latency_seconds"
+    }
+    checks = list()
+    for metric, limit_name in limits.items():
+        limit = thresholds.get(limit_name)
+        if limit is None:
+            continue
+        checks.append({"metric": metric, "value": round(metrics[metric], 4), "limit": limit,
+                       "passed": metrics[metric] <= limit})
+
+    return {
+        "passed": all(check["passed"] for check in checks),
+        "checks": checks,
+        "settings": {"workers": args.workers, "processes": args.processes, "duration": args.duration,
+                     "latency": args.latency, "error_rate": args.error_rate},
+        "totals": {"requests": requests, "errors": errors, "server": server_stats},
+        "operations": {
+            operation: {
+                "count": len(values),
+                "errors": errors_by_operation.get(operation, 0),
+                "p50_seconds": round(percentile(values, 0.5), 4),
+                "p95_seconds": round(percentile(values, 0.95), 4),
+                "max_seconds": round(max(values), 4)
+            }
+            for operation, values in sorted(latencies.items())
+        },
+        "top_errors": sorted(error_messages.items(), key=lambda item: -item[1])[:10],
+        "samples": {str(result["pid"]): result["samples"] for result in results}
+    }
+
+
+def print_report(report):
+    print("Load test {0}".format("PASSED" if report["passed"] else "FAILED"))
+    print("  requests: {requests}, errors: {errors}".format(**report["totals"]))
+    for operation, stats in report["operations"].items():
+        print("  {0:<28} count {count:>7}  errors {errors:>5}  p50 {p50_seconds:>8.4f}s  p95 {p95_seconds:>8.4f}s".format(
+            operation, **stats))
+    for check in report["checks"]:
+        print("  [{0}] {1} = {2} (limit {3})".format(
+            "PASS" if check["passed"] else "FAIL", check["metric"], check["value"], check["limit"]))
+    for message, count in report["top_errors"]:
+        print("  error x{0}: {1}".format(count, message))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrency and soak load test for ThreatStream.execute")
+    parser.add_argument("--workers", type=int, default=50, help="Total number of concurrent worker threads")
+    parser.add_argument("--processes", type=int, default=1, help="Number of processes the workers are spread over")
+    parser.add_argument("--duration", type=float, default=60, help="Length of the run, in seconds")
+    parser.add_argument("--warmup", type=float, default=5,
+                        help="Seconds after which the baseline for descriptor and memory growth is taken")
+    parser.add_argument("--sample-interval", type=float, default=1, help="Seconds between samples")
+    parser.add_argument("--mix", help="JSON file with a list of {operation, params, weight} items")
+    parser.add_argument("--config", help="JSON file with connector configuration values to override")
+    parser.add_argument("--thresholds", default=os.path.join(TOOLS_DIR, "thresholds.json"))
+    parser.add_argument("--latency", type=float, default=0.01, help="Response delay of the stub server, in seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of stub responses that fail")
+    parser.add_argument("--objects", type=int, default=2500, help="Number of intelligence objects served")
+    parser.add_argument("--cert", help="Certificate for the stub server; a temporary one is generated by default")
+    parser.add_argument("--key", help="Private key of the certificate")
+    parser.add_argument("--report", help="File to which the JSON report is written")
+    args = parser.parse_args()
+
+    mix = DEFAULT_MIX
+    if args.mix:
+        with open(args.mix) as mix_file:
+            mix = json.load(mix_file)
+    with open(args.thresholds) as thresholds_file:
+        thresholds = json.load(thresholds_file)
+
+    server = start_stub_server(args.cert, args.key, object_count=args.objects, latency=args.latency,
+                               error_rate=args.error_rate)
+    sample_dir = None
+    try:
+        config = {"base_url": server.base_url, "api_username": "loadtest", "api_key": "loadtest",
+                  "verify_ssl": False}
+        if args.config:
+            with open(args.config) as config_file:
+                config.update(json.load(config_file))
+
+        sample_dir = tempfile.mkdtemp(prefix="threatstream-loadtest-")
+        sample_path = os.path.join(sample_dir, "sample.csv")
+        with open(sample_path, "w") as sample_file:
+            sample_file.write("value,itype\n")
+            while sample_file.tell() < SAMPLE_FILE_SIZE:
+                sample_file.write("10.0.{0}.{1},c2_ip\n".format(random.randint(0, 255), random.randint(0, 255)))
+
+        if args.processes > 1:
+            threads = max(1, args.workers // args.processes)
+            arguments = [(config, mix, threads, args.duration, args.warmup, args.sample_interval, sample_path)
+                         for _ in range(args.processes)]
+            with multiprocessing.get_context("spawn").Pool(args.processes) as pool:
+                results = pool.map(run_process, arguments)
+        else:
+            results = [run_workers(config, mix, args.workers, args.duration, args.warmup, args.sample_interval,
+                                   sample_path, server)]
+        report = build_report(results, server.stats.snapshot(), thresholds, args)
+    finally:
+        # Also removes the directory of the generated certificate and private key
+        server.stop()
+        if sample_dir:
+            shutil.rmtree(sample_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+    return 0 if report["passed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,215 @@
+"""
+Copyright start
+MIT License
+Copyright (c) 2024 Fortinet Inc Copyright end
+"""
+# -----------------------------------------
+# Local stand-in for the ThreatStream API, used by the load-test and benchmark tools
+# -----------------------------------------
+
+import json
+import os
+import random
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import sleep
+from urllib.parse import urlsplit, parse_qsl
+
+DEFAULT_OBJECT_COUNT = 2500
+DEFAULT_LIST_COUNT = 45
+
+
+def generate_certificate(directory):
+    """Create a self-signed certificate for 127.0.0.1 using the openssl command line tool"""
+    if not shutil.which("openssl"):
+        raise RuntimeError("openssl is required to generate a certificate, or pass --cert and --key")
+    cert_file = os.path.join(directory, "stub.crt")
+    key_file = os.path.join(directory, "stub.key")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1",
+         "-keyout", key_file, "-out", cert_file],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return cert_file, key_file
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super(StubHandler, self).setup()
+        self.server.stats.connection_opened()
+
+    def finish(self):
+        try:
+            super(StubHandler, self).finish()
+        finally:
+            self.server.stats.connection_closed()
+
+    def send_json(self, status, body):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def handle_request(self, method):
+        parts = urlsplit(self.path)
+        query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        self.server.stats.request_received()
+        body = self.read_body() if method in ("POST", "PATCH") else b""
+        if self.server.latency:
+            sleep(self.server.latency)
+        if self.server.error_rate and random.random() < self.server.error_rate:
+            return self.send_json(500, {"error": "Injected failure"})
+        if method == "GET":
+            return self.send_json(200, self.server.get_response(parts.path, query))
+        if method == "POST":
+            status = 201 if "/tipreport/" in parts.path or "/investigationelement/" in parts.path else 202
+            return self.send_json(status, {"id": 1, "success": True, "size": len(body)})
+        return self.send_json(202, {"id": 1, "success": True})
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PATCH(self):
+        self.handle_request("PATCH")
+
+
+class ServerStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.open_connections = 0
+        self.peak_connections = 0
+        self.total_connections = 0
+        self.requests = 0
+
+    def connection_opened(self):
+        with self.lock:
+            self.open_connections += 1
+            self.total_connections += 1
+            self.peak_connections = max(self.peak_connections, self.open_connections)
+
+    def connection_closed(self):
+        with self.lock:
+            self.open_connections -= 1
+
+    def request_received(self):
+        with self.lock:
+            self.requests += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "open_connections": self.open_connections,
+                "peak_connections": self.peak_connections,
+                "total_connections": self.total_connections,
+                "requests": self.requests
+            }
+
+
+class StubThreatStream(ThreadingHTTPServer):
+    """Serves paginated intelligence, list, lookup and submission endpoints over TLS on 127.0.0.1"""
+    daemon_threads = True
+
+    def __init__(self, cert_file, key_file, object_count=DEFAULT_OBJECT_COUNT, latency=0.0, error_rate=0.0):
+        super(StubThreatStream, self).__init__(("127.0.0.1", 0), StubHandler)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        # The handshake is done by the connection thread, so that a slow client does not block accept()
+        self.socket = context.wrap_socket(self.socket, server_side=True, do_handshake_on_connect=False)
+        self.stats = ServerStats()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.objects = [
+            {
+                "id": index,
+                "value": "10.{0}.{1}.{2}".format(index // 65536 % 256, index // 256 % 256, index % 256),
+                "type": "ip",
+                "itype": ["c2_ip", "scan_ip", "mal_ip"][index % 3],
+                "confidence": index % 100,
+                "status": "active",
+                "update_id": index + 1,
+                "meta": {"severity": ["low", "medium", "high"][index % 3]}
+            }
+            for index in range(object_count)
+        ]
+        self.thread = None
+        # Directory of a generated certificate, removed when the server stops
+        self.certificate_dir = None
+
+    @property
+    def base_url(self):
+        return "https://127.0.0.1:{0}".format(self.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.certificate_dir:
+            shutil.rmtree(self.certificate_dir, ignore_errors=True)
+            self.certificate_dir = None
+
+    def paginate(self, path, query, objects):
+        limit = int(query.get("limit") or 20) or 1000
+        offset = int(query.get("offset") or 0)
+        next_page = None
+        if offset + limit < len(objects):
+            next_query = dict((k, v) for k, v in query.items() if k not in ("username", "api_key"))
+            next_query.update(limit=limit, offset=offset + limit)
+            next_page = "{0}?{1}".format(path, "&".join("{0}={1}".format(k, v) for k, v in next_query.items()))
+        return {
+            "meta": {"total_count": len(objects), "limit": limit, "offset": offset, "next": next_page},
+            "objects": objects[offset:offset + limit]
+        }
+
+    def get_response(self, path, query):
+        if path.startswith("/api/v2/intelligence"):
+            objects = self.objects
+            if query.get("value"):
+                objects = [obj for obj in objects if obj["value"] == query["value"]]
+            elif query.get("value__startswith"):
+                objects = [obj for obj in objects if obj["value"].startswith(query["value__startswith"])]
+            if query.get("update_id__gt"):
+                objects = [obj for obj in objects if obj["update_id"] > int(query["update_id__gt"])]
+            return self.paginate(path, query, objects)
+        if "/whois/" in path or "/pdns/" in path:
+            return {"data": {"path": path}}
+        return self.paginate(path, query, [{"id": index, "name": "item {0}".format(index)}
+                                           for index in range(DEFAULT_LIST_COUNT)])
+
+
+def start_stub_server(cert_file=None, key_file=None, **kwargs):
+    """Start a stub server, generating a temporary certificate when none is given"""
+    certificate_dir = None
+    if not cert_file:
+        certificate_dir = tempfile.mkdtemp(prefix="threatstream-stub-")
+        try:
+            cert_file, key_file = generate_certificate(certificate_dir)
+            server = StubThreatStream(cert_file, key_file, **kwargs)
+        except Exception:
+            shutil.rmtree(certificate_dir, ignore_errors=True)
+            raise
+    else:
+        server = StubThreatStream(cert_file, key_file, **kwargs)
+    server.certificate_dir = certificate_dir
+    return server.start()